@@ -1,4 +1,4 @@
-"""Usage: cp2gh [-vq] [--usermap=USERMAP] [--skipcp] [--onlyopen] [--filter=<f>] [--count=COUNT] [--severity=SEVERITIES] [--tag-filter=TAGS] --ghuser=GHUSER --ghpass=GHPASS [--ghorg=GHORG] CPPROJECT GHREPO
+"""Usage: cp2gh [-vq] [--usermap=USERMAP] [--skipcp | --incremental] [--onlyopen] [--filter=<f>] [--count=COUNT] [--cp-workers=N] [--parser=PARSER] [--max-attachment-size=BYTES] [--cache-max-age=SECONDS | --no-cache] [--severity=SEVERITIES] [--tag-filter=TAGS] [--gh-interval=SECONDS] [--backend=BACKEND] [--gh-workers=N] [--metrics=FILE] [--stats-interval=SECONDS] [--pipeline] [--shards=N] [--worker] [--plan=FILE] [--replay=FILE] [--rate-limit=N] --ghuser=GHUSER --ghpass=GHPASS [--ghorg=GHORG] [--ghurl=URL] [--cpurl=URL] CPPROJECT GHREPO
           
 
 Process FILE and optionally apply correction to either left-hand side or
@@ -15,13 +15,46 @@ Options:
   --ghuser=GHUSER         the username for GitHub authentication
   --ghpass=GHPASS         the password for GutHub authentication
   --ghorg=GHORG           the organization that owns the repo, if not specified, the GHUSER will be used as owner
+  --ghurl=URL             the GitHub API to talk to, e.g. for GitHub Enterprise [default: https://api.github.com]
+  --cpurl=URL             the CodePlex site of a project, with %s for the project name, e.g. for a copy of it [default: http://%s.codeplex.com]
+  --backend=BACKEND       how issues are created on GitHub: 'issues' creates each issue, comment and update with its own request,
+                          'import' sends every issue with its comments, labels, milestone and state in one request to the issue import API [default: issues]
+  --gh-workers=N          the number of issues the issues backend imports at the same time; with more than one, the GitHub
+                          issue numbers no longer follow the order of the CodePlex IDs [default: 1]
+  --gh-interval=SECONDS   the minimum time between two requests that create or change something on GitHub [default: 1]
   --usermap=USERMAP       load a file which maps CodePlex users to GitHub users
   --skipcp                skip parsing data from CodePlex and use existing issues.db file
-  --severity=SEVERITY     comma separated list of severities to keep (usually things like, e.g., 'high,medium')
-  --tag-filter=TAGFILTER  a list of tags to filter out
+  --incremental           update the existing issues.db file, only parsing work items that are new or were updated on CodePlex since the last run
+                          (ones that were imported to GitHub already are not imported again, even if they were updated)
+  --shards=N              split the work item pages still to be read, and the issues still to be imported, into N ranges of IDs
+                          and start a worker process for each, that share the ranges between them through issues.db
+  --worker                run as one of those worker processes, e.g. to add a worker with another GitHub user, or to finish the
+                          ranges of workers that stopped
+  --pipeline              import issues to GitHub while the work item pages of the others are still being read from CodePlex,
+                          instead of reading all of them first and waiting for a key press
+  --severity=SEVERITY     comma separated list of severities to keep (usually things like, e.g., 'high,medium'), issues with
+                          other severities are not imported
+  --tag-filter=TAGFILTER  comma separated list of tags (labels) to filter out, issues with any of them are not imported
   --onlyopen              only import issues that are currently open on CodePlex (this only matters during import from CodePlex to the database)
-  --filter=<f>            skip importing issues based on filtering (this will be appended to the WHERE clause)
+  --filter=<f>            only import the issues that match the filter, e.g. "Status=Active AND (Votes>=2 OR Label IN (high, medium))";
+                          it compares ID, Title, Status, Assignee, Reporter, Description, Votes, LastUpdate, Label or Milestone with
+                          =, !=, <, <=, >, >=, [NOT] IN (...) or [NOT] LIKE, combined with AND, OR, NOT and parentheses
   --count=COUNT           the number of issues to import (used mainly for testing)
+  --plan=FILE             don't import anything, but count the GitHub requests the import would take and estimate how long it
+                          would take, and write the issues as they would be imported to FILE, as a line of JSON each
+                          (implies --skipcp, it only reads issues.db)
+  --replay=FILE           import the issues in a FILE written by --plan, instead of the ones in issues.db (implies --skipcp)
+  --rate-limit=N          the number of GitHub requests allowed per hour, for the estimate of --plan [default: 5000]
+  --cp-workers=N          the number of CodePlex pages to download and parse in parallel (both list and work item pages), and
+                          of attachments to download in the background while importing [default: 1]
+  --max-attachment-size=BYTES  plain text attachments larger than this are linked to like binary ones instead of being put
+                          in a gist (gists truncate files over 1 MB) [default: 1048576]
+  --parser=PARSER         the HTML parser BeautifulSoup reads CodePlex pages with: 'lxml', 'html.parser' or 'html5lib' (by default
+                          lxml if it is installed, else html.parser)
+  --cache-max-age=SECONDS only reuse pages cached in issues.db that were downloaded less than SECONDS ago (by default cached pages never expire)
+  --metrics=FILE          also write the progress summaries to FILE, as a line of JSON each
+  --stats-interval=SECONDS  how often to print a progress summary with the throughput, ETA and timings of each phase [default: 60]
+  --no-cache              always download pages from CodePlex, refreshing the copies cached in issues.db
 
 """
 
@@ -34,9 +67,20 @@ import sqlite3
 import datetime
 import time
 import mimetypes
-import textwrap
 import math
-
+import collections
+import functools
+import itertools
+import threading
+import Queue
+import random
+import zlib
+import json
+import contextlib
+import subprocess
+import socket
+
+from multiprocessing.pool import ThreadPool
 from docopt import docopt
 
 import urllib2
@@ -44,53 +88,668 @@ import bs4
 import html2text
 import github
 
-def is_plain_text_file(filename):
-    mime = mimetypes.guess_type(filename)
-    if not mime[0]:
-        parts = os.path.splitext(filename)
-        ext = ''
-        if len(parts) > 1:
-            ext = parts[1]
-        return ext.lower() not in ['.dll', '.dat', '.zip', '.exe', '.7z', '.png', '.jpg', '.jpeg', '.docx', '.doc', '.ppt', '.pptx', '.xls', '.xlsx', '.bmp', '.gif', '.rtf', '.swf', '.blg', '.rar']    
+titleLinkRE = re.compile(r'TitleLink\d+')
+issueRowRE = re.compile(r'row_checkbox_\d+')
+commentRE = re.compile('CommentContainer\d+')
+fileLinkRE = re.compile('FileLink\d+')
+listPageTags = { 'ul' : ('class', re.compile(r'(^|\s)advanced_pagination(\s|$)')), 'tr' : ('id', issueRowRE) }
+issuePageTags = { 'a' : ('id', re.compile(r'^(ComponentLink|ReleaseLink|ReportedByLink|FileLink\d+)$')),
+                  'div' : ('id', re.compile(r'^(CommentContainer\d+|descriptionContent)$')) }
+xml_fields = [ 'Test', 'ResolvedBy', 'Description', 'Repro', 'History', 'Creator', 'CreatedDate', 'NewInternalID', 'OldInternalID', 'AreaPath', 'Area', 'OpenBuild', 'Thanks']
+binaryExtensions = ['.dll', '.dat', '.zip', '.exe', '.7z', '.png', '.jpg', '.jpeg', '.docx', '.doc', '.ppt', '.pptx', '.xls', '.xlsx', '.bmp', '.gif', '.rtf', '.swf', '.blg', '.rar']
+attachmentTypes = {}
+textBytes = ''.join(chr(x) for x in [7, 8, 9, 10, 12, 13, 27] + range(0x20, 0x7f) + range(0x80, 0x100))
+xmlFieldRE = re.compile(r'<(%s)>' % '|'.join(xml_fields))
+maxBodyBytes = 65536
+defaultLabels = { 'low' : '5BB13D', 'medium' : 'E36B23', 'high' : 'E10C02', 'task' : '4183C4' }
+
+class Metrics(object):
+    """Collects timings and counters for the stages of a migration, and reports them.
+
+    timer (or record) times a stage, e.g. downloading a page or a kind of GitHub call, and add
+    counts things; both can be used from any thread. report prints a summary of everything so far,
+    with the throughput and ETA of the current phase, every interval seconds, and writes it to output
+    as a line of JSON as well if that is set. The 95th percentile is taken over the last samples
+    samples of each timing."""
+
+    def __init__(self, interval=60, output=None, samples=10000):
+        self.interval = interval
+        self.output = output
+        self.samples = samples
+        self.lock = threading.Lock()
+        self.timings = {}
+        self.counters = collections.Counter()
+        self.phases = {}
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record(name, time.time() - start)
+
+    def record(self, name, seconds):
+        with self.lock:
+            if name not in self.timings:
+                self.timings[name] = [0, 0.0, collections.deque(maxlen=self.samples)]
+            timing = self.timings[name]
+            timing[0] += 1
+            timing[1] += seconds
+            timing[2].append(seconds)
+
+    def add(self, name, count=1):
+        with self.lock:
+            self.counters[name] += count
+
+    def report(self, phase, done, total, force=False):
+        """Reports on the progress of phase (done out of total items) if it is time to, or if force is set."""
+        now = time.time()
+        with self.lock:
+            # phases can overlap, so each keeps its own start and report times
+            if phase not in self.phases:
+                self.phases[phase] = [now, now]
+            (phaseStart, lastReport) = self.phases[phase]
+            if not force and now - lastReport < self.interval:
+                return
+            self.phases[phase][1] = now
+
+        elapsed = now - phaseStart
+        rate = done / elapsed if elapsed > 0 else 0
+        eta = (total - done) / rate if rate else None
+        with self.lock:
+            timings = {}
+            for (name, (count, seconds, samples)) in self.timings.iteritems():
+                samples = sorted(samples)
+                timings[name] = { 'count' : count, 'total' : seconds, 'mean' : seconds / count, 'p95' : samples[int(math.ceil(0.95 * len(samples))) - 1] }
+            counters = dict(self.counters)
+
+        print '%s: %d of %d done in %s, %.2f/s, ETA %s' % (phase, done, total, datetime.timedelta(seconds=int(elapsed)), rate,
+                                                           datetime.timedelta(seconds=int(eta)) if eta is not None else 'unknown')
+        for name in sorted(timings):
+            timing = timings[name]
+            print '\t%s: %d in %.1fs, mean %.0f ms, p95 %.0f ms' % (name, timing['count'], timing['total'], timing['mean'] * 1000, timing['p95'] * 1000)
+        for name in sorted(counters):
+            print '\t%s: %d' % (name, counters[name])
+        if self.output:
+            self.output.write(json.dumps({ 'time' : now, 'phase' : phase, 'done' : done, 'total' : total, 'elapsed' : elapsed, 'rate' : rate,
+                                           'eta' : eta, 'timings' : timings, 'counters' : counters }) + '\n')
+            self.output.flush()
+
+metrics = Metrics()
+
+def read_url(link, maxSize=None, accept=None):
+    """Reads the content at link, waiting and retrying until it could be retrieved.
+
+    Returns a (content, encoding) tuple, where encoding is the charset reported by the server. The
+    content is read in chunks, and if it turns out to be larger than maxSize bytes, or accept is
+    given and returns False for the first chunk, reading stops and content is None."""
+    while True:
+        try:
+            with metrics.timer('codeplex.fetch'):
+                request = urllib2.urlopen(link)
+                encoding = request.headers.getparam('charset')
+                length = request.headers.get('Content-Length')
+                if maxSize is not None and length and int(length) > maxSize:
+                    request.close()
+                    return (None, encoding)
+                chunks = []
+                size = 0
+                while True:
+                    chunk = request.read(64 * 1024)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                    if (maxSize is not None and size > maxSize) or (accept and not chunks and not accept(chunk)):
+                        request.close()
+                        return (None, encoding)
+                    chunks.append(chunk)
+                metrics.add('codeplex.bytes', size)
+                return (''.join(chunks), encoding)
+        except urllib2.HTTPError:
+            print 'HTTP error retrieving URL (%s)...waiting 10 seconds to try again' % link
+            metrics.add('codeplex.retries')
+            time.sleep(10)
+        except urllib2.URLError:
+            print 'Error retrieving URL (%s)...waiting 10 seconds to try again' % link
+            metrics.add('codeplex.retries')
+            time.sleep(10)
+        except KeyboardInterrupt:
+            raw_input('Press enter to exit cp2gh')
+            sys.exit(-1)
+
+class PageCache(object):
+    """Keeps the raw content of downloaded pages in the raw_pages table, keyed by URL.
+
+    Pages can be looked up from any thread, each of which reads through its own connection. New
+    pages are only queued though, and are written to the database by flush, through the cursor of
+    whichever thread writes to the database at the time."""
+
+    def __init__(self, path, maxAge=None):
+        self.path = path
+        self.maxAge = maxAge
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.pending = {}
+
+    def get(self, link, since=None):
+        """Returns the cached (content, encoding) for link, or None if it is missing or has expired.
+
+        If since is given, copies downloaded before that time are treated as expired too."""
+        with self.lock:
+            row = self.pending.get(link)
+        if not row:
+            if not hasattr(self.local, 'conn'):
+                self.local.conn = sqlite3.connect(self.path)
+            rows = self.local.conn.execute('SELECT FetchTime, Encoding, Content FROM raw_pages WHERE URL=?', (link, )).fetchall()
+            row = rows[0] if rows else None
+        if not row or (self.maxAge is not None and time.time() - row[0] >= self.maxAge) or (since is not None and row[0] < since):
+            return None
+        return (zlib.decompress(row[2]), row[1])
+
+    def put(self, link, content, encoding):
+        with self.lock:
+            self.pending[link] = (int(time.time()), encoding, sqlite3.Binary(zlib.compress(content)))
+
+    def read(self, link, since=None, maxSize=None, accept=None):
+        """Returns the (content, encoding) for link, downloading it with read_url if it is not cached.
+
+        Content that read_url rejects for maxSize or accept isn't downloaded completely (or cached), and is returned as None."""
+        page = self.get(link, since)
+        metrics.add('cache.hits' if page else 'cache.misses')
+        if page and ((maxSize is not None and len(page[0]) > maxSize) or (accept and not accept(page[0][:64 * 1024]))):
+            return (None, page[1])
+        if not page:
+            page = read_url(link, maxSize, accept)
+            if page[0] is not None:
+                self.put(link, page[0], page[1])
+        return page
+
+    def flush(self, c):
+        """Writes the pages downloaded since the last flush to the database."""
+        with self.lock:
+            pages = self.pending
+            self.pending = {}
+        c.executemany('INSERT OR REPLACE INTO raw_pages (URL, FetchTime, Encoding, Content) VALUES(?, ?, ?, ?)',
+                      [(link, ) + page for (link, page) in pages.iteritems()])
+
+def default_parser():
+    """Returns the fastest HTML parser installed for BeautifulSoup."""
+    if bs4.builder.builder_registry.lookup('lxml'):
+        return 'lxml'
+    return 'html.parser'
+
+def parse_page(content, encoding, parser, tags):
+    """Parses a downloaded page with the BeautifulSoup parser, only building the subtrees of the elements that
+    tags selects ({ tag name : (attribute, regular expression) }), so the rest of the page costs no objects.
+
+    The sidebar of work item pages is a table inside a div with class right_sidebar_table, which is
+    always kept as well. html5lib can't skip anything and builds the whole tree."""
+    def wanted(name, attrs):
+        if name == 'div' and 'right_sidebar_table' in attrs.get('class', '').split():
+            return True
+        (attribute, regex) = tags.get(name, (None, None))
+        return attribute is not None and regex.search(attrs.get(attribute, '')) is not None
+
+    strainer = None
+    if parser != 'html5lib':
+        strainer = bs4.SoupStrainer(wanted)
+    return bs4.BeautifulSoup(content.decode(encoding), parser, parse_only=strainer)
+
+def list_page_link(site, only_open, page):
+    """Returns the URL of one page (of 100 items) of the advanced work item list on the project site (e.g. http://PROJECTNAME.codeplex.com)."""
+    if only_open:
+        return '%s/workitem/list/advanced?keyword=&status=Open%%20(not%%20closed)&type=All&priority=All&release=All&assignedTo=All&component=All&sortField=Id&sortDirection=Ascending&size=100&page=%d' % (site, page)
+    else:
+        return '%s/workitem/list/advanced?keyword=&status=All&type=All&priority=All&release=All&assignedTo=All&component=All&sortField=Id&sortDirection=Ascending&size=100&page=%d' % (site, page)
+
+def scrape_list_page(cache, since, parser, link):
+    """Downloads (through cache, see PageCache.get for since) and parses one page of the advanced work item list with parser.
+
+    Returns a (totalItems, items) tuple, where totalItems is the item count shown in the pagination
+    (or 0 if it could not be found) and items holds a (ID, Title, Link, Assignee, Status, LastUpdate,
+    Votes, Severity, Type) tuple for each row on the page."""
+    (content, encoding) = cache.read(link, since)
+    start = time.time()
+    soup = parse_page(content, encoding, parser, listPageTags)
+
+    totalItems = 0
+    pagination = soup.find('ul', 'advanced_pagination')
+    if pagination:
+        res = re.search(r'of (\d+) items', pagination.li.get_text())
+        if res:
+            totalItems = int(res.group(1))
+
+    items = []
+    for issueRow in soup.find_all('tr', id=issueRowRE):
+        id = int(issueRow.find('td', 'ID').text)
+        votes = int(issueRow.find('td', 'Votes').text)
+        assignedTo = issueRow.find('td', 'AssignedTo').text.strip()
+        updateDate = int(issueRow.find('span', 'smartDate')['localtimeticks'])
+        titleLink = issueRow.find('a', id=titleLinkRE)
+        severity = issueRow.find('td', 'Severity').text.lower()
+        if not len(severity.strip()):
+            severity = 'low'
+
+        issueType = issueRow.find('td', 'Type').text.lower()
+        if issueType == 'issue':
+            issueType = 'bug'
+        elif issueType == 'feature':
+            issueType = 'enhancement'
+        elif issueType == 'unassigned':
+            issueType = None
+
+        items.append((id, titleLink.text, titleLink['href'], assignedTo, issueRow.find('td', 'Status').text, updateDate, votes, severity, issueType))
+
+    metrics.record('codeplex.parse.list', time.time() - start)
+    return (totalItems, items)
+
+def store_list_page(c, items):
+    """Writes the rows returned by scrape_list_page to the issues and issue_to_label tables.
+
+    Only work items that are new, or whose LastUpdate differs from the one in the database, are
+    written and flagged as Updated for the detail pass; the others are left alone. So are work
+    items that were imported to GitHub already, even if they changed, as importing them again would
+    duplicate their issue."""
+    c.execute('SELECT ID, LastUpdate, Done FROM issues WHERE ID IN (%s)' % ','.join('?' * len(items)), [item[0] for item in items])
+    known = dict((x[0], x[1:]) for x in c.fetchall())
+    items = [item for item in items if item[0] not in known or (known[item[0]][0] != item[5] and not known[item[0]][1])]
+
+    # anything we got from the detail pass before is out of date now
+    for table in ['issue_to_label', 'issue_to_milestone', 'issue_metadata', 'issue_posts']:
+        c.executemany('DELETE FROM %s WHERE IssueID=?' % table, [(item[0], ) for item in items if item[0] in known])
+    # changed rows are updated in place, so they keep the rest of their bookkeeping
+    c.executemany('UPDATE issues SET Title=?, Link=?, Assignee=?, Status=?, LastUpdate=?, Votes=?, Updated=1 WHERE ID=?',
+                  [item[1:7] + item[:1] for item in items if item[0] in known])
+    c.executemany('INSERT INTO issues (ID, Title, Link, Assignee, Status, LastUpdate, Votes, Updated) VALUES(?, ?, ?, ?, ?, ?, ?, 1)',
+                  [item[:7] for item in items if item[0] not in known])
+    labels = []
+    for (id, severity, issueType) in [(item[0], item[7], item[8]) for item in items]:
+        labels.append((id, severity))
+        if issueType:
+            labels.append((id, issueType))
+    c.executemany('INSERT OR REPLACE INTO issue_to_label (IssueID, Label) VALUES(?, ?)', labels)
+
+def text_lines(element):
+    """Returns the non-empty lines of text in element, with whitespace collapsed like a browser would.
+
+    Lines are broken at <br> and at the start of block elements; markup (like the links in the
+    sidebar) is dropped, keeping only its text."""
+    lines = [[]]
+    for node in element.descendants:
+        if isinstance(node, bs4.Comment):
+            continue
+        elif isinstance(node, bs4.NavigableString):
+            lines[-1].append(node)
+        elif node.name in ['br', 'p', 'div', 'li', 'tr', 'table', 'ul', 'ol', 'pre', 'blockquote']:
+            lines.append([])
+    lines = [' '.join(''.join(x).split()) for x in lines]
+    return [x for x in lines if x]
+
+def extract_xml_fields(description):
+    """Takes the <Field>value</Field> blocks for xml_fields out of a description (as some work items
+    migrated from TFS have them), in a single pass over it.
+
+    Returns (description, fields), where fields maps each field to the value of its first block,
+    for the fields that have one. Description, History and Repro blocks are unwrapped, leaving their
+    text in the description; the other blocks are removed, as are empty ones."""
+    fields = {}
+    first = {}
+
+    def scan(text):
+        result = []
+        pos = 0
+        for match in xmlFieldRE.finditer(text):
+            if match.start() < pos:
+                continue
+            field = match.group(1)
+            end = text.find('</%s>' % field, match.end())
+            if end < 0:
+                continue
+            result.append(text[pos:match.start()])
+            pos = end + len(field) + 3
+            value = text[match.end():end]
+            if field not in first:
+                first[field] = text[match.start():pos]
+                if value.strip():
+                    fields[field] = value.strip()
+            if field in fields and field in ['Description', 'History', 'Repro']:
+                result.append(scan(value))
+            elif text[match.start():pos] != first[field]:
+                result.append(text[match.start():pos])
+        result.append(text[pos:])
+        return ''.join(result)
+
+    return (scan(description), fields)
+
+def scrape_issue_page(cache, site, parser, row):
+    """Downloads (through cache) and parses (with parser) the CodePlex work item page for an (ID, Link, LastUpdate) row of the issues table.
+
+    This never touches the database, so it can run on the --cp-workers pool; the returned
+    dictionary is written by store_issue_page."""
+    (id, link, lastUpdate) = row
+    (content, encoding) = cache.read(link, lastUpdate)
+    start = time.time()
+    soup = parse_page(content, encoding, parser, issuePageTags)
+    page = { 'labels' : [], 'milestone' : None, 'reporter' : None, 'comments' : [], 'metadata' : [], 'attachments' : [] }
+
+    component = soup.find('a', id='ComponentLink').text
+    if component not in ['No Component Selected', 'All']:
+        page['labels'].append(component.lower())
+
+    version = soup.find('a', id='ReleaseLink').text
+    if version not in ['All', 'Unassigned']:
+        page['milestone'] = version
+
+    reportedBy = soup.find('a', id='ReportedByLink').text.strip()
+    if len(reportedBy):
+        page['reporter'] = reportedBy
+
+    for comment in soup.find_all('div', id=commentRE):
+        authorInfo = comment.find('a', 'author')
+        user = authorInfo.text
+        userlink = authorInfo['href']
+        date = int(comment.find('span', 'smartDate')['localtimeticks'])
+        page['comments'].append((date, user, userlink, comment.find('div', 'markDownOutput').text))
+
+    itemDetails = soup.find('div', 'right_sidebar_table')
+    for detailRow in itemDetails.find_all('tr'):
+        leftitems = [x.replace(':', '').strip() for x in text_lines(detailRow.find('td', 'left'))]
+        rightitems = [x.replace('n/a', '').strip() for x in text_lines(detailRow.find('td', 'right'))]
+
+        while len(rightitems) < len(leftitems):
+            rightitems.append('')
+        for (name, value) in zip(leftitems, rightitems):
+            if len(value) and name not in ['Type', 'Item number', 'User comments', 'Impact', 'Release', 'Component']:
+                page['metadata'].append((name, value))
+
+    # check the description for XML fields and update the meta data from that information
+    (description, fields) = extract_xml_fields(html2text.html2text(soup.find('div', id='descriptionContent').prettify()))
+    for xml_field in xml_fields:
+        if xml_field not in fields or xml_field in ['Description', 'History', 'Repro']:
+            continue
+        if xml_field in ['ReportedBy', 'Creator']:
+            page['reporter'] = fields[xml_field]
+        else:
+            page['metadata'].append((xml_field, fields[xml_field]))
+
+    page['description'] = description.lstrip()
+
+    for attachment in soup.find_all('a', id=fileLinkRE):
+        page['attachments'].append((attachment.text, site + attachment['href']))
+
+    metrics.record('codeplex.parse.issue', time.time() - start)
+    return page
+
+def split_text(text, limit):
+    """Splits text into pieces of at most limit bytes (as UTF-8) each, at a paragraph break if there is
+    one, otherwise at a line break or a space, so that markdown and code blocks survive the split.
+
+    Breaks are only looked for in the second half of each piece, which keeps the pieces reasonably
+    full and the split linear in the length of text. Joining the pieces gives back text."""
+    data = text.encode('utf-8')
+    pieces = []
+    start = 0
+    while len(data) - start > limit:
+        end = start + limit
+        for separator in ['\n\n', '\n', ' ']:
+            cut = data.rfind(separator, start + limit / 2, end)
+            if cut >= 0:
+                end = cut + len(separator)
+                break
+        else:
+            # don't cut a character in half
+            while end > start + 1 and (ord(data[end]) & 0xC0) == 0x80:
+                end -= 1
+        pieces.append(data[start:end].decode('utf-8'))
+        start = end
+    pieces.append(data[start:].decode('utf-8'))
+    return pieces
+
+def format_comment(date, user, comment):
+    """Returns the text of a CodePlex comment as it is posted on GitHub."""
+    commentDate = datetime.datetime(*time.gmtime(date)[:6])
+    commentor = user.strip()
+    if not commentor:
+        commentor = 'unknown user'
+    return 'On *%s*, **%s** commented:\n\n%s' % (commentDate.strftime('%Y-%m-%d %H:%M:%S UTC'), commentor, comment)
+
+def attachment_sections(id, gistURL, links):
+    """Returns the markdown that is appended to the body of issue id to link to the gist with its plain
+    text attachments (if there is a gistURL) and to the (text, href) attachments in links."""
+    sections = ''
+    if gistURL:
+        sections += '\n\n#### Plaintext Attachments\n\n[CodePlex Issue #%d Plain Text Attachments](%s)' % (id, gistURL)
+    if links:
+        sections += '\n\n#### Binary Attachments\n\n' + ''.join('[%s](%s)' % (x[0], x[1]) for x in links)
+    return sections
+
+def render_posts(id, description, comments, attachments):
+    """Returns the texts posted on GitHub for issue id: the body of the issue, then its comments.
+
+    Descriptions too long for GitHub are continued in the first comments, and comments in the ones
+    after them, so that no text is over maxBodyBytes. The body leaves room for the attachment
+    sections render_issue adds, as if all attachments were linked to and there was a gist."""
+    reserve = 0
+    if attachments:
+        reserve = len(attachment_sections(id, 'x' * 256, attachments).encode('utf-8'))
+    posts = split_text(description, maxBodyBytes - reserve)
+    for comment in comments:
+        posts.extend(split_text(format_comment(comment[0], comment[1], comment[3]), maxBodyBytes))
+    return posts
+
+def store_issue_page(c, id, link, page):
+    """Writes the work item details returned by scrape_issue_page for issue id to the database."""
+    c.executemany('INSERT OR REPLACE INTO issue_to_label (IssueID, Label) VALUES(?, ?)', [(id, label) for label in page['labels']])
+
+    if page['milestone']:
+        c.execute('INSERT OR REPLACE INTO issue_to_milestone (IssueID, Milestone) VALUES(?, ?)', (id, page['milestone']))
+
+    c.execute('DELETE FROM comments WHERE IssueId=?', (id, ))
+    c.executemany('INSERT INTO comments (IssueID, Date, User, Link, Comment) VALUES(?, ?, ?, ?, ?)', [(id, ) + comment for comment in page['comments']])
+
+    # a later value for the same name replaces the earlier one, just like the REPLACE does in the table
+    metadata = []
+    for (name, value) in page['metadata']:
+        metadata = [x for x in metadata if x[0] != name] + [(name, value)]
+    c.executemany('INSERT OR REPLACE INTO issue_metadata (IssueID, Name, Value) VALUES(?, ?, ?)', [(id, ) + x for x in metadata])
+
+    description = page['description']
+    description += 'Work Item Details\n--------------------\n'
+    description += '**Original CodePlex Issue:**\t[Issue %d](%s)\n' % (id, link)
+    for (name, value) in metadata:
+        description += '**%s:**\t%s\n' % (name, value)
+
+    # the issue is up to date now, so later runs don't read it again
+    if page['reporter']:
+        c.execute('UPDATE issues SET Reporter=?, Description=?, Updated=0 WHERE ID=?', (page['reporter'], description, id))
     else:
-       return mime[0].startswith('text')
+        c.execute('UPDATE issues SET Description=?, Updated=0 WHERE ID=?', (description, id))
 
-if __name__ == '__main__':
-    print("Parsing arguments...")
-    options = docopt(__doc__)  # parse arguments based on docstring above
-    CPPROJECT = options['CPPROJECT']
-    GHREPO = options['GHREPO']
-    username = options['--ghuser']
-    password = options['--ghpass']
-    org = options['--ghorg']
-    skipcp = ('--skipcp' in options) and options['--skipcp']
-    only_open = ('--onlyopen' in options) and options['--onlyopen']
-    curPage = 0
-    maxCount = -1
-    filter = '' 
-    validSeverities = ''
-    if  options['--severity']:
-        validSeverities = [x.strip() for x in options['--severity'].split(',')]
-    if  options['--tag-filter']:
-        tagFilter = [x.strip() for x in options['--tag-filter'].split(',')]
+    c.execute('DELETE FROM attachments WHERE IssueID=?', (id, ))
+    c.executemany('INSERT INTO attachments (IssueID, LinkText, Href) VALUES(?, ?, ?)', [(id, ) + attachment for attachment in page['attachments']])
 
-#    start_date = (datetime.datetime(1970,1,1) - datetime.datetime(1970,1,1)).total_seconds()
-    if options['--count']:
-        maxCount=int(options['--count'])
-    if options['--filter']:
-        filter = options['--filter']
+    # the import only has to send these
+    posts = render_posts(id, description, page['comments'], page['attachments'])
+    c.execute('DELETE FROM issue_posts WHERE IssueID=?', (id, ))
+    c.executemany('INSERT INTO issue_posts (IssueID, Position, Body) VALUES(?, ?, ?)', [(id, x, posts[x]) for x in range(len(posts))])
 
-    #if options['--start']:
-    #    d = datetime.datetime(1970,1,1)
-    #    start_date = (d.strptime(options['--start'], '%d/%m/%Y') - datetime.datetime(1970,1,1)).total_seconds()
+def detail_pass(conn, cache, site, parser, imap, rows, stored=None):
+    """Reads the work item page of each of rows (ID, Link, LastUpdate) and writes it to the database.
 
-    issues = {}
-    usermap = {}
+    The pages are scraped through imap, so they can be read in parallel, but come back in the same
+    order as rows, and only the calling thread writes them. If stored is set, each issue is committed
+    on its own and its ID passed to stored after that."""
+    c = conn.cursor()
+    pages = imap(functools.partial(scrape_issue_page, cache, site, parser), rows)
+    count = 0
+    for (row, page) in itertools.izip(rows, pages):
+        id = row[0]
+        link = row[1]
+
+        print '%.2f%% - Parsing issue %d from %s' % ((count / (len(rows) * 1.0)) * 100, id, link)
+        with metrics.timer('database.store.issue'):
+            store_issue_page(c, id, link, page)
+            cache.flush(c)
+        if stored:
+            conn.commit()
+            stored(id)
+        count += 1
+        metrics.report('Detail pass', count, len(rows), count == len(rows))
+    conn.commit()
+
+class ScrapePipeline(object):
+    """Runs detail_pass on a thread of its own, with its own connection to the database at path, and hands
+    out the IDs of the issues as they are committed, so they can be imported while the others are still
+    being read.
+
+    At most size IDs are queued, after that the detail pass waits for the import to catch up. batches
+    yields the IDs a list at a time until the detail pass is done (raising its error, if it failed),
+    and calls idle while there are none, so the import can carry on with the issues it has."""
+
+    def __init__(self, path, cache, site, parser, imap, rows, size=1000, batchSize=500):
+        self.queue = Queue.Queue(size)
+        self.batchSize = batchSize
+        self.error = None
+        self.done = False
+        self.thread = threading.Thread(target=self.run, args=(path, cache, site, parser, imap, rows))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self, path, cache, site, parser, imap, rows):
+        try:
+            detail_pass(open_database(path), cache, site, parser, imap, rows, self.queue.put)
+        except Exception:
+            self.error = sys.exc_info()
+        self.queue.put(None)
+
+    def batches(self, idle):
+        while not self.done:
+            try:
+                ids = [self.queue.get(True, 0.1)]
+            except Queue.Empty:
+                idle()
+                continue
+            while ids[-1] is not None and len(ids) < self.batchSize:
+                try:
+                    ids.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+            if ids[-1] is None:
+                ids.pop()
+                self.done = True
+                self.close()
+            if ids:
+                yield ids
+
+    def close(self):
+        """Waits for the detail pass to finish, dropping the IDs nobody asked for."""
+        while not self.done:
+            self.done = self.queue.get() is None
+        self.thread.join()
+        if self.error:
+            (error, self.error) = (self.error, None)
+            raise error[0], error[1], error[2]
+
+def split_shards(conn, phase, ids, count):
+    """Replaces the shards of phase ('codeplex' or 'github') with count ranges of about as many of ids (in order) each."""
+    c = conn.cursor()
+    c.execute('DELETE FROM shards WHERE Phase=?', (phase, ))
+    size = max(1, int(math.ceil(len(ids) / float(count))))
+    c.executemany('INSERT INTO shards (Phase, FirstID, LastID) VALUES(?, ?, ?)',
+                  [(phase, ids[x], ids[min(x + size, len(ids)) - 1]) for x in range(0, len(ids), size)])
+    conn.commit()
+
+class ShardClaims(object):
+    """Claims shards (see split_shards) for this worker process, one at a time.
+
+    A shard is claimed with a single UPDATE, so no two workers get the same one, and the claim is kept
+    alive by a thread that updates its Heartbeat every interval seconds. Shards whose heartbeat is more
+    than timeout seconds old are up for grabs again, so the work of a worker that crashed is picked up
+    by the others. lost is set if that happens to the shard of a worker that is still going. Workers
+    that are out of shards check for new (or abandoned) ones every pollInterval seconds."""
+
+    def __init__(self, conn, path, interval=15, timeout=60, pollInterval=1):
+        self.conn = conn
+        self.interval = interval
+        self.timeout = timeout
+        self.pollInterval = pollInterval
+        self.owner = '%s:%d' % (socket.gethostname(), os.getpid())
+        self.shard = None
+        self.lost = False
+        thread = threading.Thread(target=self.beat, args=(path, ))
+        thread.daemon = True
+        thread.start()
+
+    def beat(self, path):
+        conn = sqlite3.connect(path, timeout=60)
+        while True:
+            time.sleep(self.interval)
+            shard = self.shard
+            if shard is not None:
+                updated = conn.execute('UPDATE shards SET Heartbeat=? WHERE ID=? AND Owner=?', (int(time.time()), shard, self.owner)).rowcount
+                conn.commit()
+                if not updated and shard == self.shard:
+                    print 'Shard %d was taken over by another worker' % shard
+                    self.lost = True
+
+    def shards(self, phase):
+        """Yields the (first, last) IDs of the shards of phase this worker gets, marking each one done when
+        the next one is asked for, and waits for the shards of other workers until all of them are done."""
+        c = self.conn.cursor()
+        while True:
+            now = int(time.time())
+            c.execute("""UPDATE shards SET Owner=?, Heartbeat=? WHERE ID=(SELECT ID FROM shards
+                         WHERE Phase=? AND Done=0 AND (Owner IS NULL OR Heartbeat<?) ORDER BY ID LIMIT 1)""", (self.owner, now, phase, now - self.timeout))
+            self.conn.commit()
+            row = c.execute('SELECT ID, FirstID, LastID FROM shards WHERE Phase=? AND Owner=? AND Done=0', (phase, self.owner)).fetchone()
+            if row:
+                print 'Claimed %s shard %d for issues %d to %d' % (phase, row[0], row[1], row[2])
+                (self.shard, self.lost) = (row[0], False)
+                yield row[1:]
+                self.shard = None
+                c.execute('UPDATE shards SET Done=1 WHERE ID=? AND Owner=?', (row[0], self.owner))
+                self.conn.commit()
+            elif c.execute('SELECT COUNT(*) FROM shards WHERE Phase=? AND Done=0', (phase, )).fetchone()[0]:
+                time.sleep(self.pollInterval)
+            else:
+                return
+
+def run_workers(conn, count):
+    """Starts count worker processes (cp2gh with the same arguments and --worker) and waits for them to
+    finish, exiting if any of them failed or shards were left undone."""
+    print 'Starting %d workers...' % count
+    command = [sys.executable, os.path.abspath(__file__)] + sys.argv[1:] + ['--worker']
+    workers = [subprocess.Popen(command, stdin=open(os.devnull)) for x in range(count)]
+    failed = len([x for x in workers if x.wait() != 0])
+    left = conn.execute('SELECT COUNT(*) FROM shards WHERE Done=0').fetchone()[0]
+    if failed or left:
+        print '%d workers failed, and %d shards are left, start more with --worker to finish them' % (failed, left)
+        sys.exit(-1)
 
-    print("Connecting to database...")
+def shard_plan(claims, conn, filter, attachments, start, finish):
+    """Yields the ImportItems of the github shards claims gets, a shard at a time, through attachments.ahead.
+
+    start is called with the ImportPlan of each shard and its first ID before any of it is handed out,
+    and finish once all of it has been, before the shard is marked as done."""
+    for (first, last) in claims.shards('github'):
+        plan = ImportPlan(conn, filter, bounds=(first, last))
+        start(plan, first)
+        for item in attachments.ahead(plan):
+            if claims.lost:
+                break
+            yield item
+        finish()
 
-    conn = sqlite3.connect('issues.db')
+def open_database(path):
+    """Opens (creating or upgrading it if needed) the issues database at path and returns the connection."""
+    conn = sqlite3.connect(path, timeout=60)
     c = conn.cursor()
+    c.execute('PRAGMA journal_mode=WAL')
+    c.execute('PRAGMA synchronous=NORMAL')
+    c.execute('PRAGMA temp_store=MEMORY')
+    c.execute('PRAGMA cache_size=-65536')
+
     c.execute("""CREATE TABLE IF NOT EXISTS issues (
                  ID INTEGER PRIMARY KEY NOT NULL,
                  Link TEXT NOT NULL,
@@ -140,215 +799,1002 @@ if __name__ == '__main__':
                  Value TEXT NOT NULL,
                  FOREIGN KEY(IssueID) REFERENCES issues(ID) )""")
 
-    if options['--usermap']:
-        with open(options['--usermap'], 'r') as f:
-            for line in f:
-                items = line.split('=')
-                res = c.execute("INSERT OR REPLACE INTO usermap (CodePlexId, GitHubId) VALUES(?, ?)", (items[0].strip(), items[1].strip()))
-
-    titleLinkRE = re.compile(r'TitleLink\d+')
-    commentRE = re.compile('CommentContainer\d+')
-    fileLinkRE = re.compile('FileLink\d+')    
-    if not skipcp:
-	      c.execute('DELETE FROM issues')
+    c.execute("""CREATE TABLE IF NOT EXISTS raw_pages (
+                 URL TEXT PRIMARY KEY NOT NULL,
+                 FetchTime INTEGER NOT NULL,
+                 Encoding TEXT DEFAULT NULL,
+                 Content BLOB NOT NULL )""")
+
+    c.execute("""CREATE TABLE IF NOT EXISTS issue_posts (
+                 IssueID INTEGER NOT NULL,
+                 Position INTEGER NOT NULL,
+                 Body TEXT NOT NULL,
+                 FOREIGN KEY(IssueID) REFERENCES issues(ID) )""")
+
+    c.execute("""CREATE TABLE IF NOT EXISTS shards (
+                 ID INTEGER PRIMARY KEY NOT NULL,
+                 Phase TEXT NOT NULL,
+                 FirstID INTEGER NOT NULL,
+                 LastID INTEGER NOT NULL,
+                 Owner TEXT DEFAULT NULL,
+                 Heartbeat INTEGER DEFAULT NULL,
+                 Done INTEGER NOT NULL DEFAULT 0)""")
+
+    c.execute("""CREATE TABLE IF NOT EXISTS import_progress (
+                 IssueID INTEGER PRIMARY KEY NOT NULL,
+                 Number INTEGER DEFAULT NULL,
+                 GistURL TEXT DEFAULT NULL,
+                 ImportURL TEXT DEFAULT NULL,
+                 Comments INTEGER NOT NULL DEFAULT 0,
+                 Edited INTEGER NOT NULL DEFAULT 0,
+                 FOREIGN KEY(IssueID) REFERENCES issues(ID) )""")
+
+    # databases written by older versions have no keys on the link tables, and may well
+    # contain duplicate rows that have to go before the unique indexes can be created
+    version = c.execute('PRAGMA user_version').fetchone()[0]
+    if version < 1:
+        c.execute('DELETE FROM issue_to_label WHERE rowid NOT IN (SELECT MIN(rowid) FROM issue_to_label GROUP BY IssueID, Label)')
+        c.execute('DELETE FROM issue_to_milestone WHERE rowid NOT IN (SELECT MAX(rowid) FROM issue_to_milestone GROUP BY IssueID)')
+        c.execute('DELETE FROM issue_metadata WHERE rowid NOT IN (SELECT MAX(rowid) FROM issue_metadata GROUP BY IssueID, Name)')
+
+    c.execute('CREATE INDEX IF NOT EXISTS issues_done ON issues (Done, ID)')
+    c.execute('CREATE INDEX IF NOT EXISTS issues_updated ON issues (Updated, ID)')
+    c.execute('CREATE INDEX IF NOT EXISTS comments_issue ON comments (IssueID, Date)')
+    c.execute('CREATE INDEX IF NOT EXISTS attachments_issue ON attachments (IssueID)')
+    c.execute('CREATE UNIQUE INDEX IF NOT EXISTS issue_to_label_issue ON issue_to_label (IssueID, Label)')
+    c.execute('CREATE UNIQUE INDEX IF NOT EXISTS issue_to_milestone_issue ON issue_to_milestone (IssueID)')
+    c.execute('CREATE UNIQUE INDEX IF NOT EXISTS issue_metadata_issue ON issue_metadata (IssueID, Name)')
+    c.execute('CREATE UNIQUE INDEX IF NOT EXISTS issue_posts_issue ON issue_posts (IssueID, Position)')
+    c.execute('PRAGMA user_version=1')
+    conn.commit()
+    return conn
+
+class GitHubScheduler(object):
+    """Paces, and retries, the calls that change something on GitHub.
+
+    Calls are spaced so that the remaining quota (as reported by the rate limit headers of the last
+    response) lasts until it is reset, and never less than minInterval seconds apart, as GitHub asks
+    for requests that create content. Failed calls are retried after an exponential backoff with
+    jitter, or once the rate limit allows it again.
+
+    The rate limits are read from gh, unless the calling thread bound its own Github instance."""
+
+    def __init__(self, gh, minInterval=1.0, maxBackoff=600):
+        self.gh = gh
+        self.minInterval = minInterval
+        self.maxBackoff = maxBackoff
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.nextCall = 0
+
+    def bind(self, gh):
+        """Makes the calling thread read the rate limits from the responses to its own Github instance gh."""
+        self.local.gh = gh
+
+    def pace(self):
+        """Waits until the next call is due."""
+        gh = getattr(self.local, 'gh', self.gh)
+        (remaining, limit) = gh.rate_limiting
+        resetIn = gh.rate_limiting_resettime - time.time()
+        with self.lock:
+            due = max(time.time(), self.nextCall)
+            interval = self.minInterval
+            if remaining <= 0 and resetIn > 0:
+                print 'GitHub API rate limit exceeded need to wait %d minutes %d seconds for reset!' % divmod(math.ceil(resetIn), 60)
+                due = max(due, time.time() + resetIn)
+            elif resetIn > 0:
+                interval = max(interval, resetIn / remaining)
+            self.nextCall = due + interval
+        delay = due - time.time()
+        if delay > 0:
+            metrics.record('github.wait', delay)
+            time.sleep(delay)
+
+    def backoff(self, attempt, exception):
+        """Returns the number of seconds to wait before retrying a call that failed with exception."""
+        if isinstance(exception, github.RateLimitExceededException):
+            return max(getattr(self.local, 'gh', self.gh).rate_limiting_resettime - time.time(), 0) + 1
+        delay = min(self.maxBackoff, 2 * 2 ** attempt)
+        delay = delay / 2.0 + random.uniform(0, delay / 2.0)
+        if isinstance(exception, github.GithubException) and exception.status == 403:
+            # secondary (abuse) rate limits tell us how long to back off, or at least that it is a while
+            headers = dict((k.lower(), v) for (k, v) in (getattr(exception, 'headers', None) or {}).items())
+            if 'retry-after' in headers:
+                return int(headers['retry-after']) + random.uniform(0, 1)
+            if self.rate_limited(exception):
+                return max(delay, 60)
+        return delay
+
+    def rate_limited(self, exception):
+        """Returns whether the 403 exception is one of GitHub's rate limits (primary or secondary), rather than a denied permission."""
+        headers = dict((k.lower(), v) for (k, v) in (getattr(exception, 'headers', None) or {}).items())
+        message = str(exception.data).lower()
+        return 'retry-after' in headers or headers.get('x-ratelimit-remaining') == '0' or 'rate limit' in message or 'abuse' in message
+
+    def retryable(self, exception):
+        """Returns whether a call that failed with exception may succeed when it is retried: network errors,
+        server errors and rate limits go away, but other errors (like 401, 404 or 422) don't."""
+        if isinstance(exception, github.RateLimitExceededException):
+            return True
+        if isinstance(exception, github.GithubException):
+            return exception.status >= 500 or (exception.status == 403 and self.rate_limited(exception))
+        # socket errors, and requests' connection errors and timeouts, are all IOErrors
+        return isinstance(exception, IOError)
+
+    def call(self, action, function, *args, **kwargs):
+        """Calls function(*args, **kwargs) when it is due and retries it until it succeeds, or fails with
+        an error that retrying won't fix (see retryable), which is raised.
+
+        action describes the call for the error messages, e.g. 'creating issue'."""
+        attempt = 0
         while True:
-            contentRead = False
-            if only_open:
-                link = 'http://%s.codeplex.com/workitem/list/advanced?keyword=&status=Open%%20(not%%20closed)&type=All&priority=All&release=All&assignedTo=All&component=All&sortField=Id&sortDirection=Ascending&size=100&page=%d' % (CPPROJECT, curPage)
+            self.pace()
+            try:
+                with metrics.timer('github.' + action.replace(' ', '_')):
+                    return function(*args, **kwargs)
+            except Exception, exception:
+                if not self.retryable(exception):
+                    print '\tError %s (%s)' % (action, exception)
+                    raise
+                delay = self.backoff(attempt, exception)
+                print '\tError %s, retrying in %d seconds (%s)' % (action, delay, exception)
+                metrics.add('github.retries')
+                metrics.record('github.backoff', delay)
+                time.sleep(delay)
+                attempt += 1
+
+class IssueImporter(object):
+    """Creates issues through GitHub's issue import API.
+
+    The import API takes an issue with all of its comments, labels, milestone and state in a single
+    request and imports it in the background. submit starts such an import, and finished returns
+    the (ImportItem, Issue) pairs of the imports that have completed since, waiting for the oldest
+    one while more than window imports are pending (or for all of them if wait is set). Imports that
+    were started but not finished on a previous run (as recorded in journal) are checked on again
+    instead of being started over."""
+
+    accept = 'application/vnd.github.golden-comet-preview+json'
+
+    def __init__(self, user, repo, scheduler, attachments, journal, window=10, pollInterval=1):
+        self.user = user
+        self.repo = repo
+        self.scheduler = scheduler
+        self.attachments = attachments
+        self.journal = journal
+        self.window = window
+        self.pollInterval = pollInterval
+        self.pending = collections.deque()
+        self.polled = 0
+
+    def submit(self, item, assignee, parameters):
+        if item.progress.importURL:
+            self.pending.append((item, item.progress.importURL))
+            return
+        step = functools.partial(self.journal.record, item.id)
+        (body, comments) = render_issue(self.user, self.scheduler, self.attachments, item, step)
+        issue = { 'title' : item.title, 'body' : body, 'closed' : parameters.get('state') == 'closed' }
+        if parameters.get('labels'):
+            issue['labels'] = parameters['labels']
+        if 'milestone' in parameters:
+            issue['milestone'] = parameters['milestone'].number
+        if isinstance(assignee, github.NamedUser.NamedUser):
+            issue['assignee'] = assignee.login
+        payload = { 'issue' : issue, 'comments' : [{ 'body' : x } for x in comments] }
+        (headers, data) = self.scheduler.call('importing issue', self.repo._requester.requestJsonAndCheck, 'POST', self.repo.url + '/import/issues',
+                                              input=payload, headers={ 'Accept' : self.accept })
+        self.pending.append((item, data['url']))
+        step(ImportURL=data['url'])
+        self.journal.flush()
+
+    def finished(self, wait=False):
+        done = []
+        while self.pending:
+            # don't check more often than every pollInterval when finished is called over and over
+            if not wait and len(self.pending) <= self.window and time.time() - self.polled < self.pollInterval:
+                break
+            self.polled = time.time()
+            (item, url) = self.pending[0]
+            try:
+                (headers, data) = self.repo._requester.requestJsonAndCheck('GET', url, headers={ 'Accept' : self.accept })
+            except Exception, exception:
+                print '\tError checking import of issue %d, retrying in %d seconds (%s)' % (item.id, self.pollInterval, exception)
+                data = { 'status' : 'pending' }
+            if data['status'] == 'pending':
+                if not wait and len(self.pending) <= self.window:
+                    break
+                time.sleep(self.pollInterval)
+                continue
+
+            self.pending.popleft()
+            if data['status'] == 'imported':
+                done.append((item, self.repo.get_issue(int(data['issue_url'].rsplit('/', 1)[1]))))
             else:
-                link = 'http://%s.codeplex.com/workitem/list/advanced?keyword=&status=All&type=All&priority=All&release=All&assignedTo=All&component=All&sortField=Id&sortDirection=Ascending&size=100&page=%d' % (CPPROJECT, curPage)
-            print 'Reading content from CodePlex: %s' % link
-            while not contentRead:
-                try:
-                    request = urllib2.urlopen(link)
-                    encoding = request.headers.getparam('charset')
-                    content = request.read()
-                    contentRead = True
-                except urllib2.URLError:
-                    print 'Error retrieving URL (%s)...waiting 10 seconds to try again' % link
-                    time.sleep(10)
-                except urllib2.HTTPError:
-                    print 'HTTP error retrieving URL (%s)...waiting 10 seconds to try again' % link
-                    time.sleep(10)
-                except KeyboardInterrupt:
-                    raw_input('Press enter to exit cp2gh')
-                    sys.exit(-1)
-
-            soup = bs4.BeautifulSoup(content.decode(encoding), 'html5lib')
-            # if we're on the first page, let's get some info we'll use later
-            if curPage == 0:
-                itemsText = soup.find('ul', 'advanced_pagination').li.get_text()
-                res = re.search(r'of (\d+) items', itemsText)
-                totalItems = 0
-                totalPages = 0
-                if res:
-                    totalItems = int(res.group(1))
-                    totalPages = totalItems / 100
-                    if totalItems % 100 > 0:
-                        totalPages += 1
-
-                #for component in [x['value'] for x in soup.find('select', id='ComponentListBox').find_all('option') if x['value'] != 'No Component Selected']:
-                #    c.execute('SELECT * FROM labels WHERE Label=?', (component, ))
-                #    if c.rowcount <= 0:
-                #        c.execute('INSERT OR REPLACE INTO labels (Label) VALUES(?)', (component, ))            
-                                            
-                #for release in [x['value'] for x in soup.find('select', id='PlannedReleaseListBox').find_all('option') if x['value'] not in ['Unassigned', 'All']]:
-                #    r= c.execute('SELECT * FROM milestones WHERE Milestone=?', (release, ))
-                #    if not r:
-                #        c.execute('INSERT OR REPLACE INTO milestones (Milestone) VALUES(?)', (release, ))                    
-            
-                if not totalItems:
-                    print 'Could not parse item count from project issue tracker'
-                else:
-                    print 'Parsing %d issues from %d pages' % (totalItems, totalPages)
-        
+                print '\tError importing issue %d, it will be retried on the next run (%s)' % (item.id, data.get('errors'))
+                self.journal.record(item.id, ImportURL=None)
+        self.journal.flush()
+        return done
+
+class ImportJournal(object):
+    """Keeps track of how far the import of each issue got in the import_progress table.
+
+    An issue whose import was interrupted (by an error or by stopping cp2gh) is continued where it
+    stopped on the next run: the issue, gist and comments that were already created on GitHub are
+    reused instead of created again. Steps can be recorded from any thread, but are only written
+    (and committed) by flush, which must be called from the thread that owns conn."""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.lock = threading.Lock()
+        self.pending = []
+
+    def record(self, id, **columns):
+        """Records that the import of issue id got as far as the import_progress columns say."""
+        with self.lock:
+            self.pending.append((id, columns))
+
+    def flush(self):
+        with self.lock:
+            steps = self.pending
+            self.pending = []
+        if not steps:
+            return
+        c = self.conn.cursor()
+        for (id, columns) in steps:
+            c.execute('INSERT OR IGNORE INTO import_progress (IssueID) VALUES(?)', (id, ))
+            c.execute('UPDATE import_progress SET %s WHERE IssueID=?' % ', '.join('%s=?' % x for x in columns), columns.values() + [id])
+        self.conn.commit()
+
+def decode_text(content, encoding):
+    """Decodes downloaded text with the charset the server reported, or else as UTF-8 or Windows-1252
+    (returning content as is if neither works)."""
+    if encoding:
+        return content.decode(encoding)
+    for encoding in ['utf8', 'cp1252']:
+        try:
+            return content.decode(encoding)
+        except UnicodeDecodeError:
+            pass
+    return content
+
+def attachment_type(filename):
+    """Returns 'text' or 'binary' for the type of an attachment going by its extension, or None if that is unknown.
+
+    The answer is remembered for each extension."""
+    ext = os.path.splitext(filename)[1].lower()
+    if ext not in attachmentTypes:
+        mime = mimetypes.guess_type('attachment' + ext)[0]
+        if mime:
+            attachmentTypes[ext] = 'text' if mime.startswith('text') else 'binary'
+        elif ext in binaryExtensions:
+            attachmentTypes[ext] = 'binary'
+        else:
+            attachmentTypes[ext] = None
+    return attachmentTypes[ext]
+
+def classify_attachments(attachments):
+    """Splits (name, link) attachments into (plaintext, binary) lists by attachment_type.
+
+    Attachments of an unknown type are in plaintext, and are checked with looks_like_text once downloaded."""
+    plaintext = []
+    binary = []
+    for attachment in attachments:
+        if attachment_type(attachment[0]) == 'binary':
+            binary.append(attachment)
+        else:
+            plaintext.append(attachment)
+    return (plaintext, binary)
+
+def looks_like_text(data):
+    """Returns whether data (the start of a file) looks like text, i.e. has no control characters other than whitespace."""
+    return not data[:512].translate(None, textBytes)
+
+class AttachmentFetcher(object):
+    """Downloads the plain text attachments of issues on a pool of workers threads, ahead of their import.
+
+    ahead wraps the iteration over the issues to import, starting the downloads for the next
+    lookahead issues while the current one is being imported, and text returns the decoded content
+    of an attachment (waiting for its download if it is still running). Downloads go through cache,
+    so they are kept in issues.db. Attachments larger than maxSize bytes aren't downloaded
+    completely, and neither are attachments of an unknown type that turn out not to be text; text
+    returns None for both."""
+
+    def __init__(self, cache, workers=1, maxSize=None, lookahead=None):
+        self.cache = cache
+        self.maxSize = maxSize
+        self.pool = ThreadPool(workers)
+        self.lookahead = lookahead or 4 * workers
+        self.lock = threading.Lock()
+        self.pending = {}
+
+    def fetch(self, name, link):
+        accept = None
+        if attachment_type(name) is None:
+            accept = looks_like_text
+        (content, encoding) = self.cache.read(link, maxSize=self.maxSize, accept=accept)
+        if content is None:
+            return None
+        return decode_text(content, encoding)
+
+    def ahead(self, items):
+        upcoming = collections.deque()
+        for item in items:
+            with self.lock:
+                for (name, link) in classify_attachments(item.attachments)[0]:
+                    if link not in self.pending:
+                        self.pending[link] = self.pool.apply_async(self.fetch, (name, link))
+            upcoming.append(item)
+            if len(upcoming) > self.lookahead:
+                yield upcoming.popleft()
+        while upcoming:
+            yield upcoming.popleft()
+
+    def text(self, name, link):
+        with self.lock:
+            result = self.pending.pop(link, None)
+        if result:
+            return result.get()
+        return self.fetch(name, link)
+
+    def close(self):
+        """Stops the download threads once the downloads that were started are done."""
+        self.pool.close()
+        self.pool.join()
+
+def render_issue(user, scheduler, attachments, item, step):
+    """Returns the (body, comments) to post to GitHub for item.
+
+    Plain text attachments are read through attachments (an AttachmentFetcher) and put in a gist
+    (created through scheduler, unless item.progress has one already, and passed to step as GistURL)
+    that the body links to, binary attachments and plain text ones that are too large are linked to
+    on CodePlex. Everything else was split up by render_posts when the issue was scraped."""
+    (plaintext_attachments, binary_attachments) = classify_attachments(item.attachments)
+
+    gist_files = {}
+    for attachment in plaintext_attachments:
+        # create gist and link to that instead...
+        content = attachments.text(attachment[0], attachment[1])
+        if content is None:
+            binary_attachments.append(attachment)
+        else:
+            gist_files[attachment[0]] = github.InputFileContent(content)
+
+    gistURL = None
+    if gist_files:
+        gistURL = item.progress.gistURL
+        if not gistURL:
+            description = 'CodePlex Issue #%d Plain Text Attachments' % item.id
+            gistURL = scheduler.call('creating gist', user.create_gist, True, gist_files, description).html_url
+            step(GistURL=gistURL)
+
+    # best we can do for the rest is put in a link to the original attachment on CodePlex...
+    body = item.body + attachment_sections(item.id, gistURL, binary_attachments)
+    return (body, list(item.comments))
+
+def create_issue(user, repo, scheduler, attachments, item, assignee, parameters, step):
+    """Creates the issue for item on GitHub, followed by its comments (in order) and the update with the
+    milestone, labels and state in parameters, and returns the Issue.
+
+    Each step that is done is passed to step (as import_progress columns), and the steps item.progress
+    says were done on a previous run are skipped, as are the comments the issue has on GitHub already.
+    This doesn't touch the database, so it can run on an ImportPool worker."""
+    (body, comments) = render_issue(user, scheduler, attachments, item, step)
+    done = item.progress.comments
+    if item.progress.number:
+        ghIssue = scheduler.call('reading issue', repo.get_issue, item.progress.number)
+        # a comment that was created just before the import stopped may not have made it to the journal
+        done = max(done, ghIssue.comments)
+        # create_in_order leaves the assignee and the attachments to the update
+        parameters = dict(parameters, body=body)
+        if assignee is not github.GithubObject.NotSet:
+            parameters['assignee'] = assignee
+    else:
+        ghIssue = scheduler.call('creating issue', repo.create_issue, item.title, body=body, assignee=assignee)
+        step(Number=ghIssue.number)
+
+    #if isinstance(assignee, github.NamedUser.NamedUser):
+    #    repo.remove_from_collaborators(assignee)
+
+    for (index, comment) in enumerate(comments):
+        if index >= done:
+            scheduler.call('creating comment', ghIssue.create_comment, comment)
+            step(Comments=index + 1)
+
+    # update the issue with the information
+    if not item.progress.edited:
+        scheduler.call('updating issue', ghIssue.edit, **parameters)
+        step(Edited=1)
+    return ghIssue
+
+def create_in_order(conn, selection, repo, scheduler, journal, plan, first):
+    """Creates the issues in plan on GitHub, in order, with just their title and body, once every issue
+    before first (out of those in the ImportPlan selection) has been created, whichever worker process
+    created it.
+
+    This keeps the GitHub issue numbers in the order of the CodePlex IDs when the import is split into
+    shards. Only the creation of the issues has to wait its turn: their numbers are written to journal
+    straight away, and create_issue then adds the attachments, comments and update in parallel."""
+    turn = 'SELECT 1 FROM issues LEFT JOIN import_progress ON import_progress.IssueID=issues.ID WHERE ID<? AND Number IS NULL AND %s LIMIT 1' % selection.where
+    while conn.execute(turn, [first] + selection.params).fetchone():
+        time.sleep(1)
+    for item in plan:
+        if not item.progress.number:
+            ghIssue = scheduler.call('creating issue', repo.create_issue, item.title, body=item.body)
+            journal.record(item.id, Number=ghIssue.number)
+            journal.flush()
+
+class ImportPool(object):
+    """Imports up to workers issues to GitHub at the same time, with create_issue.
+
+    Each worker thread talks to GitHub through its own Github instance from connect, since PyGithub
+    connections can't be shared between threads. An issue is imported by a single worker from start
+    to end, so its comments stay in order. submit hands an issue to the workers, and finished returns
+    the (ImportItem, Issue) pairs that completed since, waiting for one while all workers are busy (or
+    for all of them if wait is set). The steps the workers take are written to journal by finished,
+    on the calling thread, before the worker goes on to the next step."""
+
+    def __init__(self, workers, connect, repoName, scheduler, attachments, journal):
+        self.workers = workers
+        self.connect = connect
+        self.repoName = repoName
+        self.scheduler = scheduler
+        self.attachments = attachments
+        self.journal = journal
+        self.jobs = Queue.Queue()
+        self.results = Queue.Queue()
+        self.inflight = 0
+        for x in range(workers):
+            thread = threading.Thread(target=self.work)
+            thread.daemon = True
+            thread.start()
+
+    def work(self):
+        gh = self.connect()
+        self.scheduler.bind(gh)
+        user = gh.get_user()
+        repo = gh.get_repo(self.repoName, lazy=True)
+        while True:
+            (item, assignee, parameters) = self.jobs.get()
+            try:
+                self.results.put((item, create_issue(user, repo, self.scheduler, self.attachments, item, assignee, parameters,
+                                                     functools.partial(self.step, item.id)), None))
+            except Exception:
+                self.results.put((item, None, sys.exc_info()))
+
+    def step(self, id, **columns):
+        # wait for the step to be written, so a crash can't lose it once the next one starts
+        written = threading.Event()
+        self.journal.record(id, **columns)
+        self.results.put(written)
+        written.wait()
+
+    def submit(self, item, assignee, parameters):
+        self.jobs.put((item, assignee, parameters))
+        self.inflight += 1
+
+    def finished(self, wait=False):
+        done = []
+        while self.inflight and (wait or self.inflight >= self.workers or not self.results.empty()):
+            try:
+                result = self.results.get(True, 1)
+            except Queue.Empty:
+                continue
+            self.journal.flush()
+            if not isinstance(result, tuple):
+                result.set()
+                continue
+            (item, ghIssue, error) = result
+            self.inflight -= 1
+            if error:
+                # keep the steps the other workers took since, they won't be taken again
+                self.journal.flush()
+                raise error[0], error[1], error[2]
+            done.append((item, ghIssue))
+        return done
+
+class GitHubResolver(object):
+    """Resolves the assignees, milestones and labels of issues to what the GitHub repo has.
+
+    The collaborators, milestones and labels of the repo are read once, and anything created
+    afterwards (through scheduler) is remembered, so resolving doesn't cost any requests for things
+    that already exist. Logins and labels are compared case insensitively, like GitHub does. If
+    something was created by someone else in the meantime (like another worker process), GitHub
+    answers that it already exists, and the repo is read again instead."""
+
+    def __init__(self, repo, scheduler):
+        self.repo = repo
+        self.scheduler = scheduler
+        self.collaborators = {x.login.lower() : x for x in repo.get_collaborators()}
+        self.read_milestones()
+        self.read_labels()
+
+    def read_milestones(self):
+        self.milestones = {x.title : x for x in self.repo.get_milestones()}
+        self.milestones.update({x.title : x for x in self.repo.get_milestones(state='closed')})
+
+    def read_labels(self):
+        self.labels = {x.name.lower() : x.name for x in self.repo.get_labels()}
+
+    def assignee(self, login):
+        """Returns the collaborator with login, or NotSet if there is none (issues can only be assigned to collaborators)."""
+        return self.collaborators.get(login.lower(), github.GithubObject.NotSet)
+
+    def milestone(self, title):
+        """Returns the milestone with title, creating it if needed."""
+        if title not in self.milestones:
+            try:
+                milestone = self.scheduler.call('creating milestone', self.repo.create_milestone, title)
+                self.milestones[milestone.title] = milestone
+            except github.GithubException, error:
+                if not already_exists(error):
+                    raise
+                self.read_milestones()
+        return self.milestones[title]
+
+    def label(self, name, color='000000'):
+        """Returns the name of the label name (as the repo has it), creating it with color if needed."""
+        if name.lower() not in self.labels:
+            try:
+                self.labels[name.lower()] = self.scheduler.call('creating label', self.repo.create_label, name, color).name
+            except github.GithubException, error:
+                if not already_exists(error):
+                    raise
+                self.read_labels()
+        return self.labels[name.lower()]
+
+def already_exists(error):
+    """Returns whether the GithubException error is GitHub refusing to create something that exists already."""
+    return error.status == 422 and 'already_exists' in [x.get('code') for x in (error.data or {}).get('errors', [])]
+
+def record_imported(conn, cache, imported):
+    """Marks the issues of the (ImportItem, Issue) pairs in imported as done, with their GitHub issue, and
+    drops their import_progress."""
+    c = conn.cursor()
+    c.executemany('UPDATE issues SET Done=1, Updated=0, GitHubIssueID=? WHERE ID=?', [(ghIssue.id, item.id) for (item, ghIssue) in imported])
+    c.executemany('DELETE FROM import_progress WHERE IssueID=?', [(item.id, ) for (item, ghIssue) in imported])
+    metrics.add('github.issues', len(imported))
+    cache.flush(c)
+    conn.commit()
+
+ImportItem = collections.namedtuple('ImportItem', ['id', 'title', 'body', 'status', 'assignee', 'votes', 'lastUpdate', 'comments', 'labels', 'milestone', 'attachments', 'progress'])
+ImportProgress = collections.namedtuple('ImportProgress', ['number', 'gistURL', 'importURL', 'comments', 'edited'])
+
+class IssueFilter(object):
+    """Compiles --filter, --severity and --tag-filter to a single parameterized condition on the issues table.
+
+    A filter compares the columns in columns, or the Label(s) and Milestone of an issue, with values,
+    e.g. "Status=Active AND (Votes>=2 OR Label IN (High, Medium)) AND NOT Milestone LIKE 'v1%'". Values
+    are bare words, numbers or quoted strings, and are always passed as parameters; keywords and names
+    are case insensitive. Conditions on labels and milestones ignore case as well, and become EXISTS
+    queries on the (indexed) link tables. severities keeps the issues with one of those labels, and
+    excludedTags drops the ones with any of those. A filter that doesn't parse raises a ValueError."""
+
+    columns = { 'id' : 'ID', 'title' : 'Title', 'status' : 'Status', 'assignee' : 'Assignee', 'reporter' : 'Reporter',
+                'description' : 'Description', 'votes' : 'Votes', 'lastupdate' : 'LastUpdate' }
+    links = { 'label' : ('issue_to_label', 'Label'), 'milestone' : ('issue_to_milestone', 'Milestone') }
+    operators = { '=' : '=', '==' : '=', '!=' : '!=', '<>' : '!=', '<' : '<', '<=' : '<=', '>' : '>', '>=' : '>=' }
+    tokenRE = re.compile(r"""\s*(?:('(?:[^']|'')*'|"(?:[^"]|"")*")|(<=|>=|!=|<>|==|[=<>(),])|([^\s'"()<>=!,]+))""")
+
+    def __init__(self, expression='', severities=None, excludedTags=None):
+        self.params = []
+        conditions = []
+        if expression:
+            self.tokens = self.tokenize(expression)
+            conditions.append(self.disjunction())
+            if self.tokens:
+                raise ValueError('unexpected %s' % self.tokens[0][1])
+        if severities:
+            conditions.append(self.link('label', 'IN', severities))
+        if excludedTags:
+            conditions.append('NOT ' + self.link('label', 'IN', excludedTags))
+        self.sql = ' AND '.join(conditions)
+
+    def tokenize(self, expression):
+        tokens = []
+        position = 0
+        expression = expression.strip()
+        while position < len(expression):
+            match = self.tokenRE.match(expression, position)
+            if not match:
+                raise ValueError('unexpected %s' % expression[position:].strip())
+            position = match.end()
+            (quoted, symbol, word) = match.groups()
+            if quoted:
+                tokens.append(('value', quoted[1:-1].replace(quoted[0] * 2, quoted[0])))
+            elif symbol:
+                tokens.append(('symbol', symbol))
+            elif word.upper() in ['AND', 'OR', 'NOT', 'IN', 'LIKE']:
+                tokens.append(('keyword', word.upper()))
+            else:
+                tokens.append(('word', word))
+        return tokens
+
+    def accept(self, kind, text=None):
+        if self.tokens and self.tokens[0][0] == kind and (text is None or self.tokens[0][1] == text):
+            return self.tokens.pop(0)[1]
+        return None
+
+    def expect(self, kind, text=None):
+        token = self.accept(kind, text)
+        if token is None:
+            raise ValueError('expected %s instead of %s' % (text or kind, self.tokens[0][1] if self.tokens else 'the end'))
+        return token
+
+    def disjunction(self):
+        terms = [self.conjunction()]
+        while self.accept('keyword', 'OR'):
+            terms.append(self.conjunction())
+        return terms[0] if len(terms) == 1 else '(%s)' % ' OR '.join(terms)
+
+    def conjunction(self):
+        factors = [self.factor()]
+        while self.accept('keyword', 'AND'):
+            factors.append(self.factor())
+        return ' AND '.join(factors)
+
+    def factor(self):
+        if self.accept('keyword', 'NOT'):
+            return 'NOT %s' % self.factor()
+        if self.accept('symbol', '('):
+            condition = self.disjunction()
+            self.expect('symbol', ')')
+            return '(%s)' % condition
+        name = self.expect('word')
+        if name.lower() not in self.columns and name.lower() not in self.links:
+            raise ValueError('unknown field %s, it should be one of %s' % (name, ', '.join(sorted(self.columns.values()) + ['Label', 'Milestone'])))
+        negate = self.accept('keyword', 'NOT')
+        if self.accept('keyword', 'IN'):
+            self.expect('symbol', '(')
+            values = [self.value()]
+            while self.accept('symbol', ','):
+                values.append(self.value())
+            self.expect('symbol', ')')
+            operator = 'IN'
+        elif self.accept('keyword', 'LIKE'):
+            (operator, values) = ('LIKE', [self.value()])
+        elif negate:
+            raise ValueError('expected IN or LIKE after NOT')
+        else:
+            operator = self.operators.get(self.accept('symbol'))
+            if not operator:
+                raise ValueError('expected a comparison after %s' % name)
+            values = [self.value()]
+
+        if name.lower() in self.links:
+            # "Label != x" means the issue has no label x, rather than some other label
+            if operator == '!=':
+                (negate, operator) = (True, '=')
+            elif operator not in ['=', 'IN', 'LIKE']:
+                raise ValueError('%s can only be compared with =, !=, IN or LIKE' % name)
+            condition = self.link(name.lower(), operator, values)
+        else:
+            condition = 'issues.%s %s %s' % (self.columns[name.lower()], operator, self.placeholders(operator, values))
+        return 'NOT %s' % condition if negate else condition
+
+    def value(self):
+        token = self.accept('value')
+        if token is None:
+            token = self.accept('word')
+        if token is None:
+            raise ValueError('expected a value instead of %s' % (self.tokens[0][1] if self.tokens else 'the end'))
+        if re.match(r'^-?\d+$', token):
+            return int(token)
+        return token
+
+    def placeholders(self, operator, values):
+        self.params.extend(values)
+        if operator.endswith('IN'):
+            return '(%s)' % ','.join('?' * len(values))
+        return '?'
+
+    def link(self, name, operator, values):
+        (table, column) = self.links[name]
+        return 'EXISTS (SELECT 1 FROM %s WHERE %s.IssueID=issues.ID AND %s.%s COLLATE NOCASE %s %s)' % (table, table, table, column, operator,
+                                                                                                    self.placeholders(operator, values))
+
+class ImportPlan(object):
+    """The issues still to be imported to GitHub that match filter (an IssueFilter), with everything needed to
+    import them. The plan can be narrowed down to the issues in ids, to those between the (first, last)
+    IDs in bounds, and to the first limit issues.
+
+    Iterating over the plan yields an ImportItem per issue, in ID order, with the assignee already
+    mapped to a GitHub user (or None) through the usermap table, and the ImportProgress of an import
+    that was interrupted on a previous run (see ImportJournal). The issues are read batchSize at a
+    time with a single query per table for each batch, and each batch is read completely before it
+    is handed out, so the database can be written and committed while iterating."""
+
+    def __init__(self, conn, filter=None, batchSize=500, ids=None, bounds=None, limit=None):
+        self.conn = conn
+        self.where = 'issues.Done=0'
+        self.params = []
+        if filter and filter.sql:
+            self.where += ' AND (%s)' % filter.sql
+            self.params.extend(filter.params)
+        if ids is not None:
+            self.where += ' AND issues.ID IN (%s)' % ','.join('%d' % x for x in ids)
+        if bounds is not None:
+            self.where += ' AND issues.ID BETWEEN %d AND %d' % bounds
+        self.batchSize = batchSize
+        self.limit = limit
+
+    def __len__(self):
+        count = self.conn.execute('SELECT COUNT(*) FROM issues WHERE %s' % self.where, self.params).fetchone()[0]
+        return min(count, self.limit) if self.limit else count
+
+    def selection(self):
+        """Returns the query (and its parameters) that selects the IDs of the issues in the plan, in order."""
+        return ('SELECT ID FROM issues WHERE %s ORDER BY ID LIMIT ?' % self.where, self.params + [self.limit or -1])
+
+    def names(self):
+        """Returns the sets of the (non-empty) labels and the milestones of the issues in the plan, without reading the issues themselves."""
+        (selection, params) = self.selection()
+        labels = set(x[0] for x in self.conn.execute('SELECT DISTINCT Label FROM issue_to_label WHERE IssueID IN (%s)' % selection, params) if len(x[0]))
+        milestones = set(x[0] for x in self.conn.execute('SELECT DISTINCT Milestone FROM issue_to_milestone WHERE IssueID IN (%s)' % selection, params))
+        return (labels, milestones)
+
+    def children(self, sql, ids):
+        """Runs sql (which selects IssueID first) for the issues in ids and groups the rows by issue."""
+        result = collections.defaultdict(list)
+        for row in self.conn.execute(sql % ','.join('?' * len(ids)), ids):
+            result[row[0]].append(row[1:])
+        return result
+
+    def __iter__(self):
+        lastID = -1
+        left = self.limit or -1
+        while left:
+            issues = self.conn.execute("""SELECT ID, Title, Description, Status, usermap.GitHubId, Votes, LastUpdate,
+                                                 Number, GistURL, ImportURL, IFNULL(Comments, 0), IFNULL(Edited, 0) FROM issues
+                                          LEFT JOIN usermap ON usermap.CodePlexId=issues.Assignee
+                                          LEFT JOIN import_progress ON import_progress.IssueID=issues.ID
+                                          WHERE ID>? AND %s ORDER BY ID LIMIT ?""" % self.where,
+                                       [lastID] + self.params + [min(self.batchSize, left) if left > 0 else self.batchSize]).fetchall()
+            if not issues:
+                return
+            ids = [x[0] for x in issues]
+            posts = self.children('SELECT IssueID, Body FROM issue_posts WHERE IssueID IN (%s) ORDER BY IssueID, Position', ids)
+            labels = self.children('SELECT IssueID, Label FROM issue_to_label WHERE IssueID IN (%s) ORDER BY IssueID, rowid', ids)
+            milestones = self.children('SELECT IssueID, Milestone FROM issue_to_milestone WHERE IssueID IN (%s)', ids)
+            attachments = self.children('SELECT IssueID, LinkText, Href FROM attachments WHERE IssueID IN (%s) ORDER BY IssueID, rowid', ids)
+            # issues scraped by older versions have their posts rendered here
+            missing = [x for x in ids if x not in posts]
+            if missing:
+                comments = self.children('SELECT IssueID, Date, User, Link, Comment FROM comments WHERE IssueID IN (%s) ORDER BY IssueID, Date, rowid', missing)
+                for issue in issues:
+                    if issue[0] not in posts:
+                        posts[issue[0]] = [(x, ) for x in render_posts(issue[0], issue[2], comments[issue[0]], attachments[issue[0]])]
+            for issue in issues:
+                id = issue[0]
+                milestone = milestones[id][0][0] if id in milestones else None
+                body = [x[0] for x in posts[id]]
+                yield ImportItem(*(issue[:2] + (body[0], ) + issue[3:7] + (body[1:], [x[0] for x in labels[id]], milestone, attachments[id], ImportProgress(*issue[7:]))))
+            lastID = ids[-1]
+            left -= len(ids)
+
+def estimate_import(plan, cache, backend, maxAttachmentSize, commentCounts, output=None):
+    """Counts the GitHub requests importing the ImportItems of plan with backend would take, by kind, without
+    making any, and writes each item to output (if set) as a line of JSON, for replay_plan.
+
+    commentCounts has the number of CodePlex comments of each issue, so the comments that continue a long
+    description or comment can be told apart. Attachments that are in cache are classified the way
+    AttachmentFetcher does it, the others are counted as going into a gist if they might. Labels and
+    milestones are counted as if the repo had none yet, so those counts are upper bounds."""
+    calls = collections.Counter()
+    labels = set(defaultLabels)
+    milestones = set()
+    # the user, the repo, its collaborators, labels and open and closed milestones, and the rate limit
+    calls['reads'] = 7
+    for item in plan:
+        calls['planned'] += 1
+        labels.update(x for x in item.labels if len(x))
+        if item.milestone:
+            milestones.add(item.milestone)
+
+        if not item.progress.gistURL:
+            for (name, link) in classify_attachments(item.attachments)[0]:
+                page = cache.get(link)
+                if not page or (len(page[0]) <= maxAttachmentSize and (attachment_type(name) == 'text' or looks_like_text(page[0]))):
+                    calls['gists'] += 1
+                    break
+
+        if backend == 'import':
+            if not item.progress.importURL:
+                calls['issues'] += 1
+            # checking on the import, and reading the issue once it is done
+            calls['reads'] += 2
+        else:
+            if item.progress.number:
+                calls['reads'] += 1
+            else:
+                calls['issues'] += 1
+            continuations = len(item.comments) - commentCounts.get(item.id, 0)
+            for index in range(item.progress.comments, len(item.comments)):
+                calls['continuation comments' if index < continuations else 'comments'] += 1
+            if not item.progress.edited:
+                calls['edits'] += 1
+
+        if output:
+            output.write(json.dumps(collections.OrderedDict(zip(ImportItem._fields[:-1], item[:-1])), separators=(',', ':')) + '\n')
+    calls['labels'] = len(labels)
+    calls['milestones'] = len(milestones)
+    return calls
+
+def replay_plan(conn, path):
+    """Yields the ImportItems estimate_import wrote to the file at path, with the ImportProgress of
+    the journal in conn, and skipping the issues conn has as done."""
+    done = set(x[0] for x in conn.execute('SELECT ID FROM issues WHERE Done=1'))
+    progress = dict((x[0], ImportProgress(*x[1:])) for x in conn.execute('SELECT IssueID, Number, GistURL, ImportURL, Comments, Edited FROM import_progress'))
+    with open(path) as f:
+        for line in f:
+            fields = json.loads(line)
+            if fields['id'] not in done:
+                yield ImportItem(progress=progress.get(fields['id'], ImportProgress(None, None, None, 0, 0)), **fields)
+
+if __name__ == '__main__':
+    print("Parsing arguments...")
+    options = docopt(__doc__)  # parse arguments based on docstring above
+    CPPROJECT = options['CPPROJECT']
+    site = options['--cpurl'] % CPPROJECT
+    GHREPO = options['GHREPO']
+    username = options['--ghuser']
+    password = options['--ghpass']
+    org = options['--ghorg']
+    skipcp = ('--skipcp' in options) and options['--skipcp']
+    only_open = ('--onlyopen' in options) and options['--onlyopen']
+    incremental = options['--incremental']
+    cpWorkers = int(options['--cp-workers'])
+    metrics.interval = float(options['--stats-interval'])
+    if options['--metrics']:
+        metrics.output = open(options['--metrics'], 'a')
+    maxAttachmentSize = int(options['--max-attachment-size'])
+    parser = options['--parser'] or default_parser()
+    if not bs4.builder.builder_registry.lookup(parser):
+        print 'Unknown or missing parser %s, it should be one of lxml, html.parser or html5lib' % parser
+        sys.exit(-1)
+    ghInterval = float(options['--gh-interval'])
+    ghWorkers = int(options['--gh-workers'])
+    backend = options['--backend']
+    shards = int(options['--shards'] or 0)
+    worker = options['--worker']
+    planFile = options['--plan']
+    replayFile = options['--replay']
+    if planFile or replayFile:
+        skipcp = True
+    if backend not in ['issues', 'import']:
+        print 'Unknown backend %s, it should be either issues or import' % backend
+        sys.exit(-1)
+    cacheMaxAge = None
+    if options['--cache-max-age']:
+        cacheMaxAge = int(options['--cache-max-age'])
+    if options['--no-cache']:
+        cacheMaxAge = 0
+    maxCount = None
+    validSeverities = None
+    if  options['--severity']:
+        validSeverities = [x.strip() for x in options['--severity'].split(',')]
+    tagFilter = None
+    if  options['--tag-filter']:
+        tagFilter = [x.strip() for x in options['--tag-filter'].split(',')]
+
+#    start_date = (datetime.datetime(1970,1,1) - datetime.datetime(1970,1,1)).total_seconds()
+    if options['--count']:
+        maxCount=int(options['--count'])
+    try:
+        filter = IssueFilter(options['--filter'], validSeverities, tagFilter)
+    except ValueError, error:
+        print 'Invalid filter %s: %s' % (options['--filter'], error)
+        sys.exit(-1)
+
+    #if options['--start']:
+    #    d = datetime.datetime(1970,1,1)
+    #    start_date = (d.strptime(options['--start'], '%d/%m/%Y') - datetime.datetime(1970,1,1)).total_seconds()
+
+    issues = {}
+    usermap = {}
+    pipeline = None
+
+    print("Connecting to database...")
+
+    conn = open_database('issues.db')
+    c = conn.cursor()
+
+    cache = PageCache('issues.db', cacheMaxAge)
+
+    if options['--usermap']:
+        with open(options['--usermap'], 'r') as f:
+            users = [line.split('=') for line in f]
+            c.executemany("INSERT OR REPLACE INTO usermap (CodePlexId, GitHubId) VALUES(?, ?)", [(items[0].strip(), items[1].strip()) for items in users])
+
+    if cpWorkers > 1:
+        pool = ThreadPool(cpWorkers)
+        imap = pool.imap
+    else:
+        imap = itertools.imap
+
+    if not skipcp and not worker:
+        # an incremental sync has to see the current list, but can reuse any work item page
+        # that was cached after the item was last updated
+        listSince = None
+        if incremental:
+            listSince = time.time()
+        else:
+            c.execute('DELETE FROM issues')
+
+        # the first page tells us how many pages there are, after that they can all be read at once
+        link = list_page_link(site, only_open, 0)
+        print 'Reading content from CodePlex: %s' % link
+        (totalItems, items) = scrape_list_page(cache, listSince, parser, link)
+        totalPages = 0
+        if not totalItems:
+            print 'Could not parse item count from project issue tracker'
+        else:
+            totalPages = totalItems / 100
+            if totalItems % 100 > 0:
+                totalPages += 1
+            print 'Parsing %d issues from %d pages' % (totalItems, totalPages)
+
+        links = [list_page_link(site, only_open, x) for x in range(1, totalPages)]
+        pages = itertools.chain([(totalItems, items)], imap(functools.partial(scrape_list_page, cache, listSince, parser), links))
+        for (curPage, page) in enumerate(pages):
             print 'Parsing page ', curPage
-            curPage += 1
-            issueRows = soup.find_all('tr', id=re.compile(r'row_checkbox_\d+'))
-            for issueRow in issueRows:            
-                id = int(issueRow.find('td', 'ID').text)
-                votes = int(issueRow.find('td', 'Votes').text)
-                assignedTo = issueRow.find('td', 'AssignedTo').text.strip()
-                updateDate = int(issueRow.find('span', 'smartDate')['localtimeticks'])
-                c.execute("""INSERT OR REPLACE INTO issues (ID, Title, Link, Assignee, Status, LastUpdate, Votes, Updated) VALUES(?, ?, ?, ?, ?, ?, ?, 1)""",
-                          (id, issueRow.find('a', id=titleLinkRE).text, issueRow.find('a', id=titleLinkRE)['href'], assignedTo, issueRow.find('td', 'Status').text, updateDate, votes))
-                severity = issueRow.find('td', 'Severity').text.lower()
-                if not len(severity.strip()):
-                    severity = 'low'
-
-                issueType = issueRow.find('td', 'Type').text.lower()
-                if issueType == 'issue':
-                    issueType = 'bug'
-                elif issueType == 'feature':
-                    issueType = 'enhancement'
-                elif issueType == 'unassigned':
-                    issueType = None
-
-                if not validSeverities or severity in validSeverities:
-                    c.execute('INSERT OR REPLACE INTO issue_to_label (IssueID, Label) VALUES(?, ?)', (id, severity))
-                if issueType:
-                    c.execute('INSERT OR REPLACE INTO issue_to_label (IssueID, Label) VALUES(?, ?)', (id, issueType))
-
-            if curPage >= totalPages:
-                break
+            with metrics.timer('database.store.list'):
+                store_list_page(c, page[1])
+                cache.flush(c)
+            metrics.report('List pass', curPage + 1, totalPages, curPage + 1 == totalPages)
 
         conn.commit()
 
-        xml_fields = [ 'Test', 'ResolvedBy', 'Description', 'Repro', 'History', 'Creator', 'CreatedDate', 'NewInternalID', 'OldInternalID', 'AreaPath', 'Area', 'OpenBuild', 'Thanks']
-
         # we should have a list of issues now
-        # so all we need to do is fill in the comments, description, and attachments    
-        c.execute('SELECT ID, Link FROM issues WHERE Updated=1 ORDER BY ID')
+        # so all we need to do is fill in the comments, description, and attachments
+        c.execute('SELECT ID, Link, LastUpdate FROM issues WHERE Updated=1 ORDER BY ID')
         rows = c.fetchall()
-        count = 0
-        for row in rows:            
-            id = row[0]
-            link = row[1]
-
-            print '%.2f%% - Parsing issue %d from %s' % ((count / (len(rows) * 1.0)) * 100, id, link)
-            contentRead = False
-            while not contentRead:
-                try:
-                    request = urllib2.urlopen(link)
-                    encoding = request.headers.getparam('charset')
-                    content = request.read()
-                    contentRead = True
-                except urllib2.URLError:
-                    print 'Error retrieving URL (%s)...waiting 10 seconds to try again' % link
-                    time.sleep(10)
-                except urllib2.HTTPError:
-                    print 'HTTP error retrieving URL (%s)...waiting 10 seconds to try again' % link
-                    time.sleep(10)
-                except KeyboardInterrupt:
-                    raw_input('Press enter to exit cp2gh')
-                    sys.exit(-1)
-
-            soup = bs4.BeautifulSoup(content.decode(encoding), 'html.parser')
-
-            component = soup.find('a', id='ComponentLink').text
-            if component not in ['No Component Selected', 'All']:
-                c.execute('INSERT OR REPLACE INTO issue_to_label (IssueID, Label) VALUES(?, ?)', (id, component.lower()))
-
-            version = soup.find('a', id='ReleaseLink').text
-            if version not in ['All', 'Unassigned']:
-                c.execute('INSERT OR REPLACE INTO issue_to_milestone (IssueID, Milestone) VALUES(?, ?)', (id, version))
-
-            reportedBy = soup.find('a', id='ReportedByLink').text.strip()
-            updatedBy = None
-            if not len(reportedBy):
-                updatedBy = soup.find('a', id='UpdatedByLink').text.strip()
-            else:
-                c.execute('UPDATE issues SET Reporter=? WHERE ID=?', (reportedBy, id))
-
-            comments = soup.find_all('div', id=commentRE)
-            c.execute('DELETE FROM comments WHERE IssueId=?', (id, ))
-            for comment in comments:
-                authorInfo = comment.find('a', 'author')
-                user = authorInfo.text
-                userlink = authorInfo['href']
-                date = int(comment.find('span', 'smartDate')['localtimeticks'])
-                comment = comment.find('div', 'markDownOutput').text            
-                c.execute('INSERT INTO comments (IssueID, Date, User, Link, Comment) VALUES(?, ?, ?, ?, ?)', (id, date, user, userlink, comment))
-
-            itemDetails = soup.find('div', 'right_sidebar_table')
-            for detailRow in itemDetails.find_all('tr'):
-                h = html2text.HTML2Text()
-                h.ignore_links = True
-
-                left = detailRow.find('td', 'left')
-                right = detailRow.find('td', 'right')
-                leftitems = [x.replace(':', '').strip() for x in html2text.html2text(left.prettify()).split('\n') if x]
-                rightitems = [x.replace('n/a', '').strip() for x in h.handle(right.prettify()).split('\n') if x]
-
-                while len(rightitems) < len(leftitems):
-                    rightitems.append('')
-                for (name, value) in zip(leftitems, rightitems):
-                    if len(value) and name not in ['Type', 'Item number', 'User comments', 'Impact', 'Release', 'Component']:
-                        c.execute('INSERT OR REPLACE INTO issue_metadata (IssueID, Name, Value) VALUES(?, ?, ?)', (id, name, value))                
-
-            # check the description for XML fields and update the meta data from that information
-            description = html2text.html2text(soup.find('div', id='descriptionContent').prettify())
-            for xml_field in xml_fields:
-                replaceAll = True
-                xml_start_tag = '<' + xml_field + '>'
-                xml_end_tag = '</' + xml_field + '>'
-                if description.find(xml_start_tag) >= 0:
-                    value = description[description.find(xml_start_tag) + len(xml_start_tag):description.find(xml_end_tag)].strip()
-                    fullTag = description[description.find(xml_start_tag):description.find(xml_end_tag) + len(xml_end_tag) + 1].strip()
-                    if len(value):
-                        if xml_field in ['Description', 'History', 'Repro']:
-                            replaceAll = False
-                            description = description.replace(xml_start_tag, '').replace(xml_end_tag, '')
-                        elif xml_field in ['ReportedBy', 'Creator']:
-                            reportedBy = value
-                            c.execute('UPDATE issues SET Reporter=? WHERE ID=?', (value, id))                            
-                        else:
-                            c.execute('INSERT INTO issue_metadata (IssueID, Name, Value) VALUES(?, ?, ?)', (id, xml_field, value))
-                    if replaceAll:
-                        description = description.replace(fullTag, '')                            
-        
-            description = description.lstrip()
-
-            description += 'Work Item Details\n--------------------\n'
-            description += '**Original CodePlex Issue:**\t[Issue %d](%s)\n' % (id, link)            
-            c.execute('SELECT Name, Value FROM issue_metadata WHERE IssueID=?', (id, ))
-            for metadata in c.fetchall():
-                description += '**%s:**\t%s\n' % (metadata[0], metadata[1])
-
-            c.execute('UPDATE issues SET description=? WHERE ID=?', (description, id))
-
-            attachments = soup.find_all('a', id=fileLinkRE)
-            c.execute('DELETE FROM attachments WHERE IssueID=?', (id, ))
-            for attachment in attachments:
-                c.execute('INSERT INTO attachments (IssueID, LinkText, Href) VALUES(?, ?, ?)', (id, attachment.text, 'http://%s.codeplex.com%s' % (CPPROJECT, attachment['href'])))            
-
-            count += 1
-        conn.commit()
-
-        raw_input('Please press any key to continue to import the issues to GitHub...')
+        if shards:
+            split_shards(conn, 'codeplex', [row[0] for row in rows], shards)
+        elif options['--pipeline']:
+            ready = [row[0] for row in c.execute('SELECT ID FROM issues WHERE Done=0 AND Updated=0 ORDER BY ID')]
+            pipeline = ScrapePipeline('issues.db', cache, site, parser, imap, rows)
+        else:
+            detail_pass(conn, cache, site, parser, imap, rows)
+            raw_input('Please press any key to continue to import the issues to GitHub...')
+
+    if shards and not worker:
+        # the workers read the work item pages first, and only get to import them once the labels and
+        # milestones they need have been created (below), so no two workers create the same one
+        split_shards(conn, 'github', [], shards)
+        if skipcp:
+            split_shards(conn, 'codeplex', [], shards)
+        else:
+            run_workers(conn, shards)
+
+    if worker:
+        claims = ShardClaims(conn, 'issues.db')
+        for (first, last) in claims.shards('codeplex'):
+            c.execute('SELECT ID, Link, LastUpdate FROM issues WHERE Updated=1 AND ID BETWEEN ? AND ? ORDER BY ID', (first, last))
+            detail_pass(conn, cache, site, parser, imap, c.fetchall())
+        if not c.execute("SELECT COUNT(*) FROM shards WHERE Phase='github' AND Done=0").fetchone()[0]:
+            sys.exit(0)
     
+    if planFile:
+        print 'Planning the import to GitHub...'
+        commentCounts = dict(c.execute('SELECT IssueID, COUNT(*) FROM comments GROUP BY IssueID').fetchall())
+        with open(planFile, 'w') as output:
+            calls = estimate_import(ImportPlan(conn, filter, limit=maxCount), cache, backend, maxAttachmentSize, commentCounts, output)
+        if org or '/' in GHREPO:
+            calls['reads'] += 1
+        kinds = ['issues', 'continuation comments', 'comments', 'gists', 'labels', 'milestones', 'edits']
+        writes = sum(calls[x] for x in kinds)
+        print 'Importing %d issues with the %s backend takes these requests:' % (calls['planned'], backend)
+        for kind in kinds + ['reads']:
+            print '\t%s: %d' % (kind, calls[kind])
+        # GitHubScheduler spaces the writes at least ghInterval apart, and all requests so that the rate limit lasts
+        duration = max(writes * ghInterval, (writes + calls['reads']) * 3600.0 / int(options['--rate-limit']))
+        print '%d requests in all, which take about %s at %s requests per hour' % (writes + calls['reads'], datetime.timedelta(seconds=int(duration)),
+                                                                                 options['--rate-limit'])
+        print 'The issues to import were written to %s, import them with --replay=%s' % (planFile, planFile)
+        sys.exit(0)
+
     count = 0
-    gh = github.Github(username, password, timeout=120)
+    connect = functools.partial(github.Github, username, password, base_url=options['--ghurl'], timeout=120)
+    gh = connect()
     user = gh.get_user()
 
     if org:
@@ -368,208 +1814,88 @@ if __name__ == '__main__':
     else:
         print 'Authenticated for %s as user %s' % (GHREPO, username)
 
-    labels = { 'low' : '5BB13D', 'medium' : 'E36B23', 'high' : 'E10C02', 'task' : '4183C4' }
-    existingLabels = [x.name for x in repo.get_labels()]
-    for l in labels:
-        if l not in existingLabels:
-            repo.create_label(l, labels[l])
-            existingLabels.append(l)
-
-    collaborators = [x.login for x in repo.get_collaborators()]
-
-    existingMilestones = {x.title : x.number for x in repo.get_milestones()}
-    existingMilestones.update({x.title : x.number for x in repo.get_milestones(state='closed')})
-    if filter:
-        f = 'SELECT ID, Title, Description, Status, Assignee, Votes, LastUpdate FROM issues WHERE Done=0 AND (%s) ORDER BY ID' % filter
-        c.execute('SELECT ID, Title, Description, Status, Assignee, Votes, LastUpdate FROM issues WHERE Done=0 AND (%s) ORDER BY ID' % filter)
+    scheduler = GitHubScheduler(gh, ghInterval)
+    resolver = GitHubResolver(repo, scheduler)
+    for l in defaultLabels:
+        resolver.label(l, defaultLabels[l])
+
+    if shards and not worker:
+        # --count applies to the whole import, so the shards only cover the first maxCount issues
+        plan = ImportPlan(conn, filter, limit=maxCount)
+        (labels, milestones) = plan.names()
+        for label in sorted(labels):
+            resolver.label(label)
+        for milestone in sorted(milestones):
+            resolver.milestone(milestone)
+        split_shards(conn, 'github', [row[0] for row in c.execute(*plan.selection()).fetchall()], shards)
+        run_workers(conn, shards)
+        print 'All shards are done'
+        sys.exit(0)
+
+    attachments = AttachmentFetcher(cache, cpWorkers, maxAttachmentSize)
+    journal = ImportJournal(conn)
+    if backend == 'import':
+        importer = IssueImporter(user, repo, scheduler, attachments, journal)
     else:
-        c.execute('SELECT ID, Title, Description, Status, Assignee, Votes, LastUpdate FROM issues WHERE Done=0 ORDER BY ID')
-    rows = c.fetchall()
-
-    for row in rows:
-        done = False
-
-        while not done:
-            if maxCount > 0 and count >= maxCount:
-                print 'Max count of issues reached'
-                done = True
-                count = count + 1
-                break
-            
-            print '%.2f%% - Importing issue %d to GitHub repo %s' % ((count / (len(rows) * 1.0)) * 100, row[0], repo.name)
-            if gh.rate_limiting[0] < 100:
-                print 'WARNING: GitHub API rate limit approaching soon (100 requests left)!'
-
-            while gh.rate_limiting[0] == 0:                
-                d = datetime.datetime.utcfromtimestamp(gh.rate_limiting_resettime)-datetime.datetime.utcnow()
-                mins = math.floor(d.total_seconds() / 60)
-                secs = math.ceil(d.total_seconds() - (mins * 60))
-                print 'GitHub API rate limit exceeded need to wait %d minutes %d seconds for reset!' % (mins, secs)
-                time.sleep(d.total_seconds())
-
-            body = row[2]
-            assignee = github.GithubObject.NotSet
-            if row[4]:
-                c.execute('SELECT GitHubId FROM usermap WHERE CodePlexId=?', (row[4], ))
-                u = c.fetchone()
-                if u:
-                    assignee = gh.get_user(u[0])
-                    if isinstance(assignee, github.NamedUser.NamedUser) and assignee.login not in collaborators:
-                        assignee = github.GithubObject.NotSet
-                        #repo.add_to_collaborators(assignee)
-                        #existingCollaborators.append(assignee.login)
-
-            c.execute('SELECT LinkText, Href FROM attachments WHERE IssueID=?', (row[0], ))
-
-            attachments = c.fetchall()
-            plaintext_attachments = [x for x in attachments if is_plain_text_file(x[0])]
-            binary_attachments = [x for x in attachments if not is_plain_text_file(x[0])]
-
-            gist_files = {}
-            for attachment in plaintext_attachments:
-                # create gist and link to that instead...
-                contentRead = False
-                while not contentRead:
-                    try:
-                        req = urllib2.urlopen(attachment[1])
-                        encoding = req.headers.getparam('charset')
-                        contentOrig = req.read()
-                        contentRead = True
-                    except urllib2.URLError:
-                        print 'Error retrieving URL (%s)...waiting 10 seconds to try again' % attachment[1]
-                        time.sleep(10)
-                    except urllib2.HTTPError:
-                        print 'HTTP error retrieving URL (%s)...waiting 10 seconds to try again' % attachment[1]
-                        time.sleep(10)
-                    except KeyboardInterrupt:
-                        raw_input('Press enter to exit cp2gh')
-                        sys.exit(-1)
-                
-                if not encoding:                
-                    encodings = ['utf8', 'cp1252']
-                    for encoding in encodings:
-                        try:
-                            content = contentOrig.decode(encoding)
-                            break
-                        except UnicodeDecodeError:
-                            content = contentOrig
-                else:
-                    content = contentOrig.decode(encoding)
-            
-                gist_files[attachment[0]] = github.InputFileContent(content)
-            
-            continuations = []
-            if len(body) >= (32*1024):
-                continuations = textwrap.wrap(body, 32*1024)      
-                body = continuations.pop(0)              
-
-            if gist_files:
-                created = False
-                while not created:
-                    try:
-                        g = user.create_gist(True, gist_files, 'CodePlex Issue #%d Plain Text Attachments' % row[0])
-                        body += '\n\n#### Plaintext Attachments\n\n[%s](%s)' % (g.description, g.html_url)            
-                        created = True
-                    except:
-                        print '\tError creating gist, retrying in 2 seconds'
-                        time.sleep(2)
-
-            if binary_attachments:
-                body += '\n\n#### Binary Attachments\n\n'
-            for attachment in binary_attachments:
-                # best we can do is put in a link to the original attachment on CodePlex...            
-                body += '[%s](%s)' % (attachment[0], attachment[1])
-
-            created = False
-            while not created:
-                try:
-                    ghIssue = repo.create_issue(row[1], body=body, assignee=assignee)
-                    created = True
-                except github.GithubException, exception:
-                    print '\tError creating issue, retrying in 2 seconds (%s)' % exception
-                    time.sleep(2)
-                except:
-                    print '\tError creating issue, retrying in 2 seconds'
-                    time.sleep(2)
-
-            if continuations:
-                for comment in continuations:
-                    created = False
-                    while not created:
-                        try:
-                            ghIssue.create_comment(comment)
-                            created = True
-                        except:
-                            print '\tError creating comment, retrying in 2 seconds'
-                            time.sleep(2)
-
-            #if isinstance(assignee, github.NamedUser.NamedUser):
-            #    repo.remove_from_collaborators(assignee)
-
-            c.execute('SELECT Date, User, Link, Comment, IssueID FROM comments WHERE IssueID=? ORDER BY Date ASC', (row[0], ))
-            for comment in sorted(c.fetchall(), cmp=lambda x, y: cmp(x[0], y[0])):
-                commentDate = time.gmtime(comment[0])[:6]
-                commentDate = datetime.datetime(*commentDate)
-                commentor = comment[1].strip()
-                if commentor in ['', u'']:
-                    commentor = 'unknown user'
-                created = False
-                while not created:
-                    try:
-                        ghIssue.create_comment('On *%s*, **%s** commented:\n\n%s' % (commentDate.strftime('%Y-%m-%d %H:%M:%S UTC'), commentor, comment[3]))
-                        created = True
-                    except:
-                        print '\tError creating comment, retrying in 2 seconds'
-                        time.sleep(2)
-                time.sleep(2)    
-
-            m = c.execute('SELECT Milestone FROM issue_to_milestone WHERE IssueID=?', (row[0], )).fetchone()
-            parameters = {}
-            if m:
-                if m[0] in existingMilestones.keys():
-                    parameters['milestone'] = repo.get_milestone(existingMilestones[m[0]])
-                else:
-                    created = False
-                    while not created:
-                        try:
-                            milestone = repo.create_milestone(m[0])
-                            created = True
-                        except:
-                            print '\tError creating milestone, retrying in 2 seconds'
-                            time.sleep(2)
-                    existingMilestones[milestone.title] = milestone.number
-                    parameters['milestone'] = milestone
-
-            c.execute('SELECT Label FROM issue_to_label WHERE IssueID=?', (row[0], ))
-            for label in c.fetchall():
-                if 'labels' not in parameters:
-                    parameters['labels'] = []
-
-                if len(label[0]) and ((not validSeverities or label[0] in validSeverities) or (not tagFilter or label[0] in tagFilter)):
-                    if (label[0] not in existingLabels):
-                        l = repo.create_label(label[0], '000000')
-                        parameters['labels'].append(l.name)
-                        existingLabels.append(l.name)
-                    else:
-                        parameters['labels'].append(label[0])
-
-            if row[3] == 'Closed':
-                parameters['state'] = 'closed'
-            
-            # update the issue with the information
-            updated = False
-            while not updated:
-                try:
-                    ghIssue.edit(**parameters)
-                    updated = True
-                except:
-                    print '\tError updating issue, retrying in 2 seconds'
-                    time.sleep(2)
-
-            c.execute('UPDATE issues SET Done=1, Updated=0, GitHubIssueID=? WHERE ID=?', (ghIssue.id, row[0]))
-            conn.commit()
-
-            count += 1
-            done = True
-    
-    raw_input('Press enter to continue...')
+        importer = ImportPool(ghWorkers, connect, repo.full_name, scheduler, attachments, journal)
+
+    plan = ImportPlan(conn, filter, limit=maxCount)
+    total = len(plan)
+    if replayFile:
+        total = sum(1 for x in replay_plan(conn, replayFile))
+        if maxCount:
+            total = min(total, maxCount)
+        plan = itertools.islice(replay_plan(conn, replayFile), maxCount)
+    elif worker:
+        start = lambda plan, first: None
+        if backend == 'issues':
+            start = functools.partial(create_in_order, conn, ImportPlan(conn, filter), repo, scheduler, journal)
+        plan = shard_plan(claims, conn, filter, attachments, start, lambda: record_imported(conn, cache, importer.finished(True)))
+    elif pipeline:
+        # issues that were read on an earlier run can go first, the others follow as the detail pass stores them
+        # (ready was listed before the detail pass started, as it clears Updated of the issues it stores)
+        idle = lambda: record_imported(conn, cache, importer.finished())
+        batches = itertools.chain((ready[x:x + 500] for x in range(0, len(ready), 500)), pipeline.batches(idle))
+        plan = itertools.chain.from_iterable(ImportPlan(conn, filter, ids=ids) for ids in batches)
+    if pipeline:
+        plan = itertools.islice(plan, maxCount)
+    if not worker:
+        plan = attachments.ahead(plan)
+    for item in plan:
+        print '%.2f%% - Importing issue %d to GitHub repo %s' % ((count / (total * 1.0)) * 100, item.id, repo.name)
+
+        assignee = github.GithubObject.NotSet
+        if item.assignee:
+            assignee = resolver.assignee(item.assignee)
+            #repo.add_to_collaborators(assignee)
+
+        parameters = {}
+        if item.milestone:
+            parameters['milestone'] = resolver.milestone(item.milestone)
+
+        for label in item.labels:
+            if 'labels' not in parameters:
+                parameters['labels'] = []
+
+            if len(label):
+                parameters['labels'].append(resolver.label(label))
+
+        if item.status == 'Closed':
+            parameters['state'] = 'closed'
+
+        importer.submit(item, assignee, parameters)
+        record_imported(conn, cache, importer.finished())
+        count += 1
+        metrics.report('Import', count, total)
+
+    record_imported(conn, cache, importer.finished(True))
+    if pipeline:
+        pipeline.close()
+    if cpWorkers > 1:
+        pool.close()
+        pool.join()
+    attachments.close()
+    metrics.report('Import', count, total, True)
+
+    if not worker:
+        raw_input('Press enter to continue...')
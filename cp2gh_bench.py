@@ -0,0 +1,344 @@
+"""Usage: cp2gh_bench [--items=N] [--cp-latency=SECONDS] [--gh-latency=SECONDS] [--rate-limit=N] [--rate-window=SECONDS] [--keep=DIR] [--] [CP2GH_OPTIONS...]
+
+
+Runs cp2gh against a synthetic CodePlex project and a fake GitHub API, both served locally, and
+reports how long the migration and each of its phases took.
+
+Arguments:
+  CP2GH_OPTIONS           extra options for cp2gh, e.g. --cp-workers=4 --gh-workers=4 (put -- before them)
+
+Options:
+  -h --help
+  --items=N               the number of work items in the synthetic project, e.g. 100, 10000 or 100000 [default: 100]
+  --cp-latency=SECONDS    the time the CodePlex stand-in takes to answer each request [default: 0]
+  --gh-latency=SECONDS    the time the fake GitHub API takes to answer each request [default: 0]
+  --rate-limit=N          the number of requests the fake GitHub API allows per rate limit window [default: 100000]
+  --rate-window=SECONDS   the length of the rate limit window of the fake GitHub API [default: 3600]
+  --keep=DIR              run cp2gh in DIR and keep its issues.db and metrics there, instead of in a temporary directory
+
+"""
+
+import sys
+import os.path
+import re
+import cgi
+import json
+import time
+import shutil
+import tempfile
+import threading
+import subprocess
+import urlparse
+import BaseHTTPServer
+import SocketServer
+
+from docopt import docopt
+
+severities = ['', 'Low', 'Medium', 'High']
+types = ['Issue', 'Feature', 'Task', 'Unassigned']
+
+def work_item(id):
+    """Returns the fields of synthetic work item id; every item is different, but the same on every run."""
+    return { 'id' : id, 'title' : 'Work item %d <with markup>' % id, 'status' : 'Closed' if id % 3 == 0 else 'Active',
+             'severity' : severities[id % 4], 'type' : types[id % 4], 'votes' : id % 7,
+             'assignee' : 'user%d' % (id % 5) if id % 2 else '', 'updated' : 1300000000 + id * 60 }
+
+def list_page(site, total, page):
+    """Returns page (of 100 items) of the advanced work item list of a project with total work items."""
+    rows = []
+    for id in range(page * 100 + 1, min(total, (page + 1) * 100) + 1):
+        item = work_item(id)
+        rows.append('''<tr id="row_checkbox_%(id)d"><td class="ID">%(id)d</td><td class="Votes">%(votes)d</td>
+<td class="Title"><a id="TitleLink%(id)d" href="%(site)s/workitem/%(id)d">%(escapedTitle)s</a></td>
+<td class="Status">%(status)s</td><td class="Type">%(type)s</td><td class="Severity">%(severity)s</td>
+<td class="AssignedTo">%(assignee)s</td><td class="LastUpdated"><span class="smartDate" localtimeticks="%(updated)d">date</span></td></tr>''' %
+                    dict(item, site=site, escapedTitle=cgi.escape(item['title'])))
+    return '''<html><head><title>Issues</title></head><body><div id="content">
+<ul class="advanced_pagination"><li>Showing %d - %d of %d items</li><li>Next</li></ul>
+<table class="grid">%s</table></div></body></html>''' % (page * 100 + 1, min(total, (page + 1) * 100), total, '\n'.join(rows))
+
+def issue_page(id):
+    """Returns the work item page of synthetic work item id.
+
+    Work items have up to three comments, every fifth one has a text, an image and an unknown
+    attachment, every seventh one has TFS style XML fields in its description and every fiftieth one
+    has a description too long for a single GitHub issue."""
+    item = work_item(id)
+    comments = []
+    for x in range(id % 4):
+        comments.append('''<div id="CommentContainer%d" class="comment"><a class="author" href="/site/users/view/user%d">commenter%d</a>
+<span class="smartDate" localtimeticks="%d">date</span><div class="markDownOutput"><p>Comment %d on work item %d with <b>markup</b> &amp; entities</p>
+<pre>code line 1
+  indented line 2</pre></div></div>''' % (x, x, x, item['updated'] + x, x, id))
+    files = ''
+    if id % 5 == 0:
+        files = ''.join('<a id="FileLink%d" href="/downloads/%d/%s">%s</a> ' % (x, id, name, name) for (x, name) in enumerate(['log.txt', 'screen.png', 'notes.cs']))
+    description = '<p>Description of work item %d.</p><p>Second paragraph with a <a href="http://example.com">link</a>.</p>' % id
+    if id % 7 == 0:
+        description += '<p>&lt;Test&gt;tested&lt;/Test&gt;</p><p>&lt;Description&gt;inner description&lt;/Description&gt;</p><p>&lt;Creator&gt;creator%d&lt;/Creator&gt;</p>' % id
+    if id % 50 == 0:
+        description += ''.join('<p>Long paragraph %d %s</p>' % (x, 'lorem ipsum dolor sit amet ' * 40) for x in range(60))
+    return '''<html><body><div id="descriptionContent">%(description)s</div>
+%(comments)s
+<div class="right_sidebar_table"><table>
+<tr><td class="left">Status:</td><td class="right">%(status)s</td></tr>
+<tr><td class="left">Type:</td><td class="right">%(type)s</td></tr>
+<tr><td class="left">Impact:</td><td class="right">%(severity)s</td></tr>
+<tr><td class="left">Release:</td><td class="right"><a id="ReleaseLink" href="#">%(release)s</a></td></tr>
+<tr><td class="left">Component:</td><td class="right"><a id="ComponentLink" href="#">%(component)s</a></td></tr>
+<tr><td class="left">Reported by:</td><td class="right"><a id="ReportedByLink" href="#">reporter%(reporter)d</a></td></tr>
+<tr><td class="left">Opened:<br/>Closed:</td><td class="right">Jan 1, 2012<br/>n/a</td></tr>
+<tr><td class="left">Votes:</td><td class="right">%(votes)d</td></tr>
+</table></div>
+%(files)s
+</body></html>''' % dict(item, description=description, comments='\n'.join(comments), files=files, reporter=id % 9,
+                          release='v%d.0' % (id % 3) if id % 3 else 'Unassigned', component='Core' if id % 2 else 'No Component Selected')
+
+def attachment(id, name):
+    if name.endswith('.png'):
+        return '\x89PNG\r\n\x1a\n' + '\x00\x01' * 1000
+    return ('line of attachment %s of work item %d caf\xc3\xa9\n' % (name, id)) * 100
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # send the headers and body of a response together, or delayed ACKs add 40 ms to every request
+    wbufsize = -1
+    latency = 0
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, body, contentType, headers={}):
+        time.sleep(self.latency)
+        self.send_response(status)
+        self.send_header('Content-Type', contentType)
+        self.send_header('Content-Length', str(len(body)))
+        for (name, value) in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+class CodePlexHandler(Handler):
+    """Serves the work item list, work item pages and attachments of a synthetic project with items work items.
+
+    Whatever comes before /workitem/ or /downloads/ in a path is taken as the project site, so cp2gh
+    is run with --cpurl=http://HOST:PORT/%s."""
+
+    items = 100
+
+    def do_GET(self):
+        site = 'http://%s%s' % (self.headers['Host'], self.path.split('/workitem/')[0].split('/downloads/')[0])
+        path = urlparse.urlparse(self.path)
+        match = re.search(r'/workitem/list/advanced$', path.path)
+        if match:
+            page = int(urlparse.parse_qs(path.query)['page'][0])
+            return self.reply(200, list_page(site, self.items, page), 'text/html; charset=utf-8')
+        match = re.search(r'/workitem/(\d+)$', path.path)
+        if match:
+            return self.reply(200, issue_page(int(match.group(1))), 'text/html; charset=utf-8')
+        match = re.search(r'/downloads/(\d+)/(.+)$', path.path)
+        if match:
+            return self.reply(200, attachment(int(match.group(1)), match.group(2)), 'application/octet-stream')
+        self.reply(404, 'Not found', 'text/plain')
+
+class GitHubHandler(Handler):
+    """Answers the GitHub API calls cp2gh makes for a single repo, keeping what was created in memory.
+
+    Every response counts against a rate limit of rateLimit requests per rateWindow seconds and
+    reports it in the X-RateLimit headers; once it is used up requests fail with 403 until the
+    window resets. Like GitHub, creating a label or milestone that exists already (labels being
+    compared case insensitively) fails with 422 already_exists."""
+
+    rateLimit = 100000
+    rateWindow = 3600
+    lock = threading.Lock()
+    windowStart = time.time()
+    used = 0
+    calls = 0
+    issues = {}
+    milestones = {}
+    labels = {}
+    imports = {}
+    gists = 0
+
+    def reply(self, status, data):
+        cls = GitHubHandler
+        with cls.lock:
+            now = time.time()
+            if now >= cls.windowStart + cls.rateWindow:
+                cls.windowStart = now
+                cls.used = 0
+            cls.used += 1
+            cls.calls += 1
+            remaining = max(cls.rateLimit - cls.used, 0)
+            if cls.used > cls.rateLimit:
+                (status, data) = (403, { 'message' : 'API rate limit exceeded' })
+            reset = int(cls.windowStart + cls.rateWindow) + 1
+        Handler.reply(self, status, json.dumps(data), 'application/json; charset=utf-8',
+                      { 'X-RateLimit-Limit' : str(self.rateLimit), 'X-RateLimit-Remaining' : str(remaining), 'X-RateLimit-Reset' : str(reset) })
+
+    def handle_call(self, method):
+        cls = GitHubHandler
+        path = urlparse.urlparse(self.path).path
+        length = int(self.headers.get('Content-Length') or 0)
+        data = json.loads(self.rfile.read(length)) if length else {}
+        api = 'http://%s' % self.headers['Host']
+        repo = api + '/repos/owner/repo'
+
+        def issue(number):
+            return dict(cls.issues[number], number=number, id=number, url='%s/issues/%d' % (repo, number), html_url='%s/issues/%d' % (repo, number))
+
+        if path == '/rate_limit':
+            return self.reply(200, { 'resources' : { 'core' : { 'limit' : self.rateLimit, 'remaining' : self.rateLimit, 'reset' : int(time.time()) + 1 } },
+                                     'rate' : { 'limit' : self.rateLimit, 'remaining' : self.rateLimit, 'reset' : int(time.time()) + 1 } })
+        if path == '/user':
+            return self.reply(200, { 'login' : 'owner', 'id' : 1, 'url' : api + '/users/owner' })
+        match = re.match(r'^/users/([^/]+)$', path)
+        if match:
+            return self.reply(200, { 'login' : match.group(1), 'id' : 2, 'url' : api + path })
+        if path == '/gists' and method == 'POST':
+            with cls.lock:
+                cls.gists += 1
+                number = cls.gists
+            return self.reply(201, { 'id' : str(number), 'description' : data.get('description'), 'html_url' : 'https://gist.example.com/%d' % number,
+                                     'url' : '%s/gists/%d' % (api, number), 'files' : {} })
+        match = re.match(r'^/repos/[^/]+/[^/]+(/.*)?$', path)
+        if not match:
+            return self.reply(404, { 'message' : 'Not Found' })
+        path = match.group(1) or ''
+        if path == '':
+            return self.reply(200, { 'name' : 'repo', 'full_name' : 'owner/repo', 'id' : 1, 'url' : repo })
+        if path == '/collaborators':
+            return self.reply(200, [{ 'login' : 'user1', 'id' : 3, 'url' : api + '/users/user1' }, { 'login' : 'user3', 'id' : 4, 'url' : api + '/users/user3' }])
+        if path == '/labels':
+            if method == 'POST':
+                with cls.lock:
+                    exists = data['name'].lower() in cls.labels
+                    if not exists:
+                        cls.labels[data['name'].lower()] = data
+                if exists:
+                    return self.reply(422, already_exists('Label', 'name'))
+                return self.reply(201, dict(data, url='%s/labels/%s' % (repo, data['name'])))
+            return self.reply(200, [dict(x, url='%s/labels/%s' % (repo, x['name'])) for x in cls.labels.values()])
+        if path == '/milestones':
+            if method == 'POST':
+                with cls.lock:
+                    exists = data['title'] in [x['title'] for x in cls.milestones.values()]
+                    if not exists:
+                        number = len(cls.milestones) + 1
+                        cls.milestones[number] = { 'title' : data['title'], 'number' : number, 'state' : data.get('state', 'open'),
+                                                   'url' : '%s/milestones/%d' % (repo, number) }
+                if exists:
+                    return self.reply(422, already_exists('Milestone', 'title'))
+                return self.reply(201, cls.milestones[number])
+            state = urlparse.parse_qs(urlparse.urlparse(self.path).query).get('state', ['open'])[0]
+            return self.reply(200, [x for x in cls.milestones.values() if state in ['all', x['state']]])
+        match = re.match(r'^/milestones/(\d+)$', path)
+        if match:
+            return self.reply(200, cls.milestones[int(match.group(1))])
+        if path == '/issues' and method == 'POST':
+            with cls.lock:
+                number = len(cls.issues) + 1
+                cls.issues[number] = dict(data, state='open', comments=0)
+            return self.reply(201, issue(number))
+        match = re.match(r'^/issues/(\d+)$', path)
+        if match:
+            number = int(match.group(1))
+            if method == 'PATCH':
+                cls.issues[number].update(data)
+            return self.reply(200, issue(number))
+        match = re.match(r'^/issues/(\d+)/comments$', path)
+        if match:
+            number = int(match.group(1))
+            cls.issues[number]['comments'] += 1
+            return self.reply(201, { 'id' : cls.issues[number]['comments'], 'body' : data['body'], 'url' : '%s/comments/%d' % (repo, cls.issues[number]['comments']) })
+        if path == '/import/issues' and method == 'POST':
+            with cls.lock:
+                number = len(cls.issues) + 1
+                cls.issues[number] = dict(data['issue'], state='closed' if data['issue'].get('closed') else 'open', comments=len(data.get('comments', [])))
+                cls.imports[number] = number
+            return self.reply(202, { 'id' : number, 'status' : 'pending', 'url' : '%s/import/issues/%d' % (repo, number) })
+        match = re.match(r'^/import/issues/(\d+)$', path)
+        if match:
+            number = cls.imports[int(match.group(1))]
+            return self.reply(200, { 'id' : number, 'status' : 'imported', 'issue_url' : '%s/issues/%d' % (repo, number) })
+        self.reply(404, { 'message' : 'Not Found' })
+
+    def do_GET(self):
+        self.handle_call('GET')
+
+    def do_POST(self):
+        self.handle_call('POST')
+
+    def do_PATCH(self):
+        self.handle_call('PATCH')
+
+def already_exists(resource, field):
+    """Returns the body of GitHub's 422 response to creating a resource whose field is taken."""
+    return { 'message' : 'Validation Failed', 'errors' : [{ 'resource' : resource, 'code' : 'already_exists', 'field' : field }],
+             'documentation_url' : 'https://developer.github.com/v3' }
+
+def serve(handler):
+    """Starts serving handler on a free local port in the background, and returns the server."""
+    server = Server(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+def phase_timings(path):
+    """Returns the elapsed time of each phase, and the timings of the last summary, from a cp2gh --metrics file."""
+    phases = {}
+    last = None
+    with open(path) as f:
+        for line in f:
+            last = json.loads(line)
+            phases[last['phase']] = last['elapsed']
+    return (phases, last['timings'] if last else {})
+
+if __name__ == '__main__':
+    options = docopt(__doc__)
+    CodePlexHandler.items = int(options['--items'])
+    CodePlexHandler.latency = float(options['--cp-latency'])
+    GitHubHandler.latency = float(options['--gh-latency'])
+    GitHubHandler.rateLimit = int(options['--rate-limit'])
+    GitHubHandler.rateWindow = float(options['--rate-window'])
+
+    codeplex = serve(CodePlexHandler)
+    github = serve(GitHubHandler)
+
+    directory = options['--keep'] or tempfile.mkdtemp(prefix='cp2gh_bench')
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    metricsFile = os.path.join(directory, 'metrics.jsonl')
+    if os.path.exists(metricsFile):
+        os.remove(metricsFile)
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cp2gh.py'),
+               '--ghuser=owner', '--ghpass=secret', '--ghurl=http://127.0.0.1:%d' % github.server_address[1],
+               '--cpurl=http://127.0.0.1:%d/%%s' % codeplex.server_address[1], '--gh-interval=0', '--metrics=%s' % metricsFile,
+               '--stats-interval=3600'] + options['CP2GH_OPTIONS'] + ['project', 'repo']
+
+    print 'Migrating %d work items in %s' % (CodePlexHandler.items, directory)
+    start = time.time()
+    with open(os.path.join(directory, 'cp2gh.log'), 'w') as log:
+        process = subprocess.Popen(command, cwd=directory, stdin=subprocess.PIPE, stdout=log, stderr=subprocess.STDOUT)
+        process.communicate('\n' * 10)
+    elapsed = time.time() - start
+    if process.returncode:
+        print 'cp2gh failed with exit code %d, see %s' % (process.returncode, os.path.join(directory, 'cp2gh.log'))
+        sys.exit(process.returncode)
+
+    (phases, timings) = phase_timings(metricsFile)
+    print 'Total: %.2fs for %d work items (%.1f/s), %d GitHub requests' % (elapsed, CodePlexHandler.items, CodePlexHandler.items / elapsed, GitHubHandler.calls)
+    for phase in ['List pass', 'Detail pass', 'Import']:
+        if phase in phases:
+            print '\t%s: %.2fs' % (phase, phases[phase])
+    for name in sorted(timings):
+        timing = timings[name]
+        print '\t%s: %d in %.2fs, mean %.1f ms, p95 %.1f ms' % (name, timing['count'], timing['total'], timing['mean'] * 1000, timing['p95'] * 1000)
+
+    if not options['--keep']:
+        shutil.rmtree(directory)
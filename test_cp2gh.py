@@ -0,0 +1,77 @@
+"""Usage: test_cp2gh [--update]
+
+Checks that every HTML parser cp2gh can use (and is installed) extracts the same fields from the synthetic
+CodePlex pages of cp2gh_bench as are recorded in test_cp2gh.json, which html5lib extracted from them.
+html5lib builds the whole tree, so this also checks that the parsers that skip most of it with the
+SoupStrainer of parse_page don't lose anything.
+
+Options:
+  --update                record what html5lib extracts now in test_cp2gh.json, instead of testing
+
+"""
+
+import sys
+import os.path
+import json
+import unittest
+
+import cp2gh
+import cp2gh_bench
+
+site = 'http://project.codeplex.com'
+listItems = 30
+issueIDs = [1, 2, 3, 5, 7, 14, 35]
+expectedPath = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test_cp2gh.json')
+
+class PageStandIn(object):
+    """Hands out the synthetic pages of cp2gh_bench in place of a PageCache."""
+
+    def read(self, link, since):
+        if '/workitem/list/' in link:
+            return (cp2gh_bench.list_page(site, listItems, int(link.rsplit('=', 1)[1])), 'utf-8')
+        return (cp2gh_bench.issue_page(int(link.rsplit('/', 1)[1])), 'utf-8')
+
+def extract(parser):
+    """Returns what scrape_list_page and scrape_issue_page extract from the synthetic pages with parser, as it is stored in JSON."""
+    cache = PageStandIn()
+    lists = [cp2gh.scrape_list_page(cache, None, parser, cp2gh.list_page_link(site, False, x)) for x in range(1)]
+    issues = dict(('%d' % x, cp2gh.scrape_issue_page(cache, site, parser, (x, '%s/workitem/%d' % (site, x), 0))) for x in issueIDs)
+    return json.loads(json.dumps({ 'lists' : lists, 'issues' : issues }))
+
+def installed(parser):
+    try:
+        cp2gh.bs4.BeautifulSoup('<p></p>', parser)
+        return True
+    except cp2gh.bs4.FeatureNotFound:
+        return False
+
+class ParserTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        with open(expectedPath) as f:
+            cls.expected = json.load(f)
+
+    def check(self, parser):
+        if not installed(parser):
+            self.skipTest('%s is not installed' % parser)
+        actual = extract(parser)
+        self.assertEqual(actual['lists'], self.expected['lists'])
+        for id in sorted(self.expected['issues'], key=int):
+            self.assertEqual(actual['issues'][id], self.expected['issues'][id], 'work item %s differs' % id)
+
+    def test_lxml(self):
+        self.check('lxml')
+
+    def test_html_parser(self):
+        self.check('html.parser')
+
+    def test_html5lib(self):
+        self.check('html5lib')
+
+if __name__ == '__main__':
+    if '--update' in sys.argv:
+        with open(expectedPath, 'w') as f:
+            json.dump(extract('html5lib'), f, indent=1, sort_keys=True, separators=(',', ': '))
+    else:
+        unittest.main()